@@ -100,10 +100,10 @@ def collect():
       medida["type-tag-salted"] = "TrafficFlowObserved"
       tosend.append(medida)
       
-    # send data to mapper
+    # send data to mapper, one measurement per line so it can map them while reading
     if (len(tosend) == 0): return
-    m_json = json.dumps(tosend, indent=3)
-    res = s.post('http://'+mapper_address+':'+str(mapper_port)+'/UCmapper_batch', data=m_json)
+    m_ndjson = (json.dumps(medida)+"\n" for medida in tosend)
+    res = s.post('http://'+mapper_address+':'+str(mapper_port)+'/UCmapper_batch', headers={"Content-Type": "application/x-ndjson"}, data=m_ndjson)
     logger.info("Batch sent")
 
 if __name__ == '__main__':
@@ -16,7 +16,8 @@ def findk(k,tofind):
 		if key.endswith('/'+k): return key,True
 	return None,False
 
-def check(medida,tipo):
+# partial entities only carry the attributes that changed, so a missing location is not an error
+def check(medida,tipo,partial=False):
 	error = 0
 	dtime = datetime.now().astimezone(pytz.utc)
 	obsat = str(dtime).replace(' ','T').replace('+00:00','Z')
@@ -27,7 +28,7 @@ def check(medida,tipo):
 			del medida["location"]
 			error = 1
 			medida["location_unavailable"] = {"type":"Property","value":True, "observedAt": obsat}
-	else:
+	elif not partial:
 		error = 1
 		medida["location_unavailable"] = {"type":"Property","value":True, "observedAt": obsat}
 
@@ -11,6 +11,8 @@ import injector, check_errors, stream_assessment
 import json, requests, signal
 import paho.mqtt.client as mqtt
 import os, inspect, configparser, logging
+try: import msgpack
+except ImportError: msgpack = None
 
 PROGRAM_NAME = inspect.stack()[0][1].split('.py', 1)[0].split('\\')[-1].split('/')[-1]
 PROGRAM_PATH = os.path.dirname(os.path.realpath(__file__))
@@ -21,6 +23,8 @@ config.read(PROGRAM_PATH + '/general.conf')
 broker_address = config.get('scorpio','SCORPIO_IP')
 mqtt_address = config.get('scorpio','MQTT_IP')
 LOG_LEVEL = config.getint('curator','LOG_LEVEL')
+# shards of the mapper topics handled by this instance, all of them if empty
+SHARDS = [shard.strip() for shard in config.get('curator','SHARDS',fallback='').split(',') if shard.strip()]
 
 # Set up logger
 logger = logging.getLogger(PROGRAM_NAME + "_logger")
@@ -40,6 +44,12 @@ def exit_gracefully(signal, _):
 signal.signal(signal.SIGINT, exit_gracefully)
 signal.signal(signal.SIGTERM, exit_gracefully)
 
+# the mapper publishes JSON, whose entities always start with { or [, or MessagePack
+def decode(payload):
+  if payload[:1] in (b"{", b"[", b" ", b"\n"): return json.loads(payload.decode("utf-8"))
+  if msgpack is None: raise ValueError("MessagePack payload but msgpack is not installed")
+  return msgpack.unpackb(payload, raw=False)
+
 class Handler:
   # always use same HTTP session
   def __init__(self):
@@ -48,23 +58,27 @@ class Handler:
   # subscribe on connect
   def on_connect(self, client, userdata, flags, rc):
     if (rc == 0):
-      client.subscribe("#",0)
+      if len(SHARDS) == 0: client.subscribe("#",0)
+      else: client.subscribe([("+/+/"+shard,0) for shard in SHARDS])
     else:
       logger.error("Connection failed: RC "+str(rc))
       exit()
 
   def receive_data(self, client, userdata, message):
     try:
-      # topic is <type>/<mode>
+      # topic is <type>/<mode> or <type>/<mode>/<shard>
       tipo = message.topic.split("/")[0]
-      modo = message.topic.split("/")[-1]
+      modo = message.topic.split("/")[1]
     except:
       logger.error("Unrecognized topic "+message.topic)
       return
     
     # get data
-    data = message.payload.decode("utf-8")
-    medidas = json.loads(data)
+    try:
+      medidas = decode(message.payload)
+    except Exception as exception_error:
+      logger.error("Undecodable payload on "+message.topic+": "+str(exception_error))
+      return
     if modo == "stream":
       medida_checked, error = check_errors.check(medidas,tipo)
       if error:
@@ -87,11 +101,21 @@ class Handler:
         medidas_final.append(medida_checked)
       # inject entity into the broker
       sc = injector.inject(medidas_final, self.session)
+    elif modo == "delta":
+      # only the attributes that changed, sent by the mapper for batches only,
+      # which are not assessed either; single or in a list
+      if type(medidas) != list: medidas = [medidas]
+      medidas_final = list()
+      for medida in medidas:
+        medida_checked, error = check_errors.check(medida,tipo,True)
+        medidas_final.append(medida_checked)
+      sc = injector.inject(medidas_final, self.session)
 
 if __name__ == '__main__':
   # begin MQTT subscription
   handler = Handler()
-  client = mqtt.Client(client_id="salted_curator")
+  # every instance needs its own client id, or the broker disconnects the others
+  client = mqtt.Client(client_id="salted_curator"+"".join("_"+shard for shard in SHARDS))
   client.on_message = handler.receive_data
   client.on_connect = handler.on_connect
   client.connect(mqtt_address,1883,0)
@@ -0,0 +1,72 @@
+# Software Name: async_server.py
+# SPDX-FileCopyrightText: Copyright (c) 2023 Universidad de Cantabria
+# SPDX-License-Identifier: LGPL-3.0
+#
+# This software is distributed under the LGPL-3.0 license;
+# see the LICENSE file for more details.
+#
+# Author: Victor GONZALEZ (Universidad de Cantabria) <vgonzalez@tlmat.unican.es> et al.
+
+import metrics
+import asyncio, time
+from aiohttp import web
+
+# the same routes as the Flask application of mapper.py served by aiohttp, so
+# many small requests share a single thread; records are only parsed here,
+# mapping and publishing run in the ingest workers of the mapper
+class AsyncMapper:
+  def __init__(self, mapper):
+    self.mapper = mapper
+
+  def too_many_requests(self):
+    return web.json_response({"message": "Mapper busy, retry later"}, status=429, headers={"Retry-After": str(self.mapper.RETRY_AFTER)})
+
+  async def stream(self, request):
+    data = await request.read()
+    if not self.mapper.queue_stream(data): return self.too_many_requests()
+    return web.json_response(None, status=202)
+
+  async def batch(self, request):
+    if request.content_type in self.mapper.NDJSON_TYPES: return await self.batch_ndjson(request)
+    data = await request.read()
+    # big bodies would block every other request while parsed
+    queued = await asyncio.get_running_loop().run_in_executor(None, self.mapper.queue_batch, data)
+    if not queued: return self.too_many_requests()
+    return web.json_response(None, status=202)
+
+  # one record per line, queued in chunks while the request is read
+  async def batch_ndjson(self, request):
+    loop = asyncio.get_running_loop()
+    tipo = None
+    medidas = list()
+    accepted = False
+    start = time.perf_counter()
+    async for line in request.content:
+      if len(line.strip()) == 0: continue
+      medida, tipo = self.mapper.parse_line(line, tipo)
+      medidas.append(medida)
+      if len(medidas) == self.mapper.INGEST_CHUNK_SIZE:
+        metrics.observe("parse", self.mapper.label_type(tipo), "batch", time.perf_counter() - start)
+        # waiting for room in the queue must not block the event loop
+        if not await loop.run_in_executor(None, self.mapper.queue_chunk, medidas, accepted): return self.too_many_requests()
+        accepted = True
+        medidas = list()
+        start = time.perf_counter()
+    if len(medidas) > 0:
+      metrics.observe("parse", self.mapper.label_type(tipo), "batch", time.perf_counter() - start)
+      if not await loop.run_in_executor(None, self.mapper.queue_chunk, medidas, accepted): return self.too_many_requests()
+    return web.json_response(None, status=202)
+
+  async def metrics(self, request):
+    return web.Response(body=metrics.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4"})
+
+  def app(self):
+    app = web.Application(client_max_size=0)
+    app.router.add_post("/UCmapper_stream", self.stream)
+    app.router.add_post("/UCmapper_batch", self.batch)
+    app.router.add_get("/metrics", self.metrics)
+    return app
+
+# serve until the process is stopped; the signals are left to the handlers of mapper.py
+def serve(host, port, mapper):
+  web.run_app(AsyncMapper(mapper).app(), host=host, port=port, print=None, access_log=None, handle_signals=False)
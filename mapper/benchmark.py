@@ -0,0 +1,203 @@
+# Software Name: benchmark.py
+# SPDX-FileCopyrightText: Copyright (c) 2023 Universidad de Cantabria
+# SPDX-License-Identifier: LGPL-3.0
+#
+# This software is distributed under the LGPL-3.0 license;
+# see the LICENSE file for more details.
+#
+# Author: Victor GONZALEZ (Universidad de Cantabria) <vgonzalez@tlmat.unican.es> et al.
+
+import map_fields
+import json, glob, os, sys, timeit, numpy, copy, time, random, resource, subprocess, argparse, platform
+
+PROGRAM_PATH = os.path.dirname(os.path.realpath(__file__))
+
+# previous nested-loop matching, kept as reference for the vectorized engine
+def match_fields_loop(model, medida_text):
+  train_vecs = [list(row[row != map_fields.TRAIN_PAD]) for row in model.train_vecs]
+  test_vecs = [model.vectorizer.unique_indices(text) for text in medida_text]
+
+  predictions = list()
+  for it_test in range(len(test_vecs)):
+    arrayNewDist = [numpy.array([]),numpy.array([])]
+    for it_train in range(len(train_vecs)):
+      min_dist = 1000 #"infinite"
+      count = 0
+      for elem in train_vecs[it_train]:
+        for elem2 in test_vecs[it_test]:
+          dist = abs(elem - elem2)
+          if dist < min_dist:
+            min_dist = dist
+            count = 1
+          elif dist == min_dist:
+            count += 1
+      arrayNewDist[0] = numpy.append(arrayNewDist[0], min_dist)
+      arrayNewDist[1] = numpy.append(arrayNewDist[1], count)
+
+    distIndex = numpy.argsort(arrayNewDist[0])
+    dist_ordenada = numpy.take(arrayNewDist[0], distIndex)
+    count_ordenada = numpy.take(arrayNewDist[1], distIndex)
+    distancia_min = dist_ordenada[0]
+    for it_dist in range(len(dist_ordenada)):
+      if (dist_ordenada[it_dist] > distancia_min):
+        dist_ordenada = dist_ordenada[0:it_dist]
+        count_ordenada = count_ordenada[0:it_dist]
+        break
+    countIndex = numpy.argsort(count_ordenada)
+    final_dist = dist_ordenada[countIndex[-1]]
+    final_counts = count_ordenada[countIndex[-1]]
+    if (final_dist != 0): verosimilitud = 0
+    elif (final_counts == 1): verosimilitud = 1
+    elif (final_counts == 2): verosimilitud = 2
+    else: verosimilitud = 3
+    predictions.append((model.train_labels[distIndex[countIndex[-1]]], final_dist, final_counts, verosimilitud))
+  return predictions
+
+# field texts of a record, as mapper() computes them
+def record_text(medida):
+  medida_flattened = map_fields.flatten_json(medida)
+  return [map_fields.json_to_text({k:v}) for k,v in medida_flattened.items()]
+
+def matching(repeat):
+  print("{:<25} {:>7} {:>12} {:>12} {:>8}".format("Type","Fields","Loop (us)","Vector (us)","Speedup"))
+  for path in sorted(glob.glob(PROGRAM_PATH + "/sdm/*/ej.txt")):
+    tipo = path.split("/")[-2]
+    with open(path, "r") as f: medida = json.loads(f.read())
+    model = map_fields.get_model(tipo)
+    medida_text = record_text(medida)
+
+    if match_fields_loop(model, medida_text) != map_fields.match_fields(model, medida_text):
+      print(tipo + ": vectorized predictions differ from the loop ones")
+      sys.exit(1)
+
+    t_loop = min(timeit.repeat(lambda: match_fields_loop(model, medida_text), number=repeat, repeat=3)) / repeat
+    t_vector = min(timeit.repeat(lambda: map_fields.match_fields(model, medida_text), number=repeat, repeat=3)) / repeat
+    print("{:<25} {:>7} {:>12.1f} {:>12.1f} {:>7.1f}x".format(tipo, len(medida_text), t_loop*1e6, t_vector*1e6, t_loop/t_vector))
+
+# records shaped like the ones every collector sends, as (type, function(i) -> (record, unit data))
+def example(tipo):
+  with open(PROGRAM_PATH + "/sdm/" + tipo + "/ej.txt", "r") as f: medida = json.loads(f.read())
+  return tipo, lambda i: (copy.deepcopy(medida), None)
+
+def smartsantander(tipo):
+  with open(PROGRAM_PATH + "/sdm/" + tipo + "/ej.txt", "r") as f: medida = json.loads(f.read())
+  def record(i):
+    m = copy.deepcopy(medida)
+    m["urn"] = m["urn"].rsplit(":", 1)[0] + ":t" + str(i)
+    if "value" in m: m["value"] = round(random.uniform(0, 100), 2)
+    return m, None
+  return tipo, record
+
+def bilbao(i):
+  feature = {"type": "Feature", "geometry": {"type": "Point", "coordinates": [-2.95 + i*1e-4, 43.27]},
+    "properties": {"CodigoSeccion": "bilbao:"+str(i), "Ocupacion": random.randint(0,100), "Intensidad": random.randint(0,2000),
+      "Velocidad": random.randint(0,90), "FechaHora": "2023-05-23T08:10:00Z"}}
+  return feature, {"properties": {"Ocupacion": "P1", "Intensidad": "vehicles per hour", "Velocidad": "KMH"}}
+
+def valencia(i):
+  feature = {"type": "Feature", "geometry": {"type": "LineString", "coordinates": [[-0.37, 39.46 + i*1e-4], [-0.38, 39.47]]},
+    "properties": {"idtramo": "valencia:"+str(i), "des_tramo": "Gran Via Fernando el Catolico", "lectura": random.randint(0,3000)}}
+  return feature, {"properties": {"lectura": "vehicles per hour"}}
+
+def barcelona(i):
+  medida = {"id_tramo": "barcelona:"+str(i), "location": {"type": "LineString", "coordinates": [[2.11, 41.38 + i*1e-4], [2.12, 41.39], [2.13, 41.39]]},
+    "time_observed": "2023-05-23T08:10:00Z", "congested": random.random() > 0.8}
+  return medida, None
+
+def santander_bicis(i):
+  medida, _ = example("BikeHireDockingStation")[1](i)
+  medida["dc:identifier"] = "santander:"+str(i)
+  for k in ("ayto:total_puestos", "ayto:bicicletas_libres", "ayto:puestos_libres"): medida[k] = random.randint(0,20)
+  return medida, None
+
+def santander_buses(i):
+  medida, _ = example("FleetVehicleStatus")[1](i)
+  medida["ayto:vehiculo"] = "santander:"+str(i)
+  medida["ayto:velocidad"] = round(random.uniform(0, 50), 1)
+  return medida, {"ayto:velocidad": "KMH"}
+
+SOURCES = {
+  "bilbao": ("TrafficFlowObserved", bilbao),
+  "valencia": ("TrafficFlowObserved", valencia),
+  "barcelona": ("TrafficFlowObserved", barcelona),
+  "santander_bicis": ("BikeHireDockingStation", santander_bicis),
+  "santander_buses": ("FleetVehicleStatus", santander_buses),
+}
+for tipo in ("Temperature", "BatteryStatus", "ParkingSpot", "SoundPressureLevel", "ElectroMagneticObserved", "AirQualityObserved"):
+  SOURCES["smartsantander_" + tipo] = smartsantander(tipo)
+for path in sorted(glob.glob(PROGRAM_PATH + "/sdm/*/ej.txt")):
+  SOURCES["example_" + path.split("/")[-2]] = example(path.split("/")[-2])
+
+# map <records> records of a source in batches of <size> (1 means stream) and measure it;
+# run in its own process so the peak RSS belongs to this case only
+def run_case(source, size, records):
+  random.seed(0)
+  map_fields.new_words.add = lambda tipo, words: None # do not record words of synthetic data
+  map_fields.dedup_window.window = 0 # synthetic records repeat ids and dates
+  map_fields.plan_store.path = None # do not save plans of synthetic data
+  tipo, generate = SOURCES[source]
+  numBatches = max(1, records // size) + 1 # the first one warms up the caches
+  batches = [[generate(i) for i in range(it*size, (it+1)*size)] for it in range(numBatches)]
+
+  latencies = list() # seconds per batch, records are not timed on their own
+  cold = None
+  start_all = None
+  for batch in batches:
+    medidas = [medida for medida, _ in batch]
+    unitDatas = [unitData for _, unitData in batch]
+    start = time.perf_counter()
+    if size == 1: map_fields.mapper(medidas[0], tipo, unitDatas[0])
+    else: map_fields.mapper_batch(medidas, tipo, unitDatas)
+    elapsed = time.perf_counter() - start
+    if cold is None:
+      cold = elapsed
+      start_all = time.perf_counter()
+      continue
+    latencies.append(elapsed)
+  total = time.perf_counter() - start_all
+
+  return {
+    "source": source, "type": tipo, "batch_size": size, "records": len(latencies) * size, "batches": len(latencies),
+    "records_per_sec": round(len(latencies) * size / total, 1),
+    "batch_p50_ms": round(float(numpy.percentile(latencies, 50)) * 1e3, 4),
+    "batch_p99_ms": round(float(numpy.percentile(latencies, 99)) * 1e3, 4),
+    "cold_ms": round(cold * 1e3, 3),
+    "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+  }
+
+def throughput(sources, sizes, records, output):
+  results = list()
+  # latencies are per request: a single record with batch size 1, a whole batch otherwise
+  print("{:<36} {:>6} {:>8} {:>10} {:>14} {:>14} {:>10}".format("Source","Batch","Batches","Records/s","Batch p50 (ms)","Batch p99 (ms)","RSS (MB)"))
+  for source in sources:
+    for size in sizes:
+      res = subprocess.run([sys.executable, os.path.realpath(__file__), "case", source, str(size), str(records)], capture_output=True, text=True, check=True)
+      result = json.loads(res.stdout.splitlines()[-1])
+      results.append(result)
+      print("{:<36} {:>6} {:>8} {:>10.0f} {:>14.3f} {:>14.3f} {:>10.1f}".format(source, size, result["batches"], result["records_per_sec"], result["batch_p50_ms"], result["batch_p99_ms"], result["peak_rss_mb"]))
+
+  report = {"python": platform.python_version(), "numpy": numpy.__version__, "date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "results": results}
+  with open(output, "w") as f: f.write(json.dumps(report, indent=3))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Mapper benchmarks")
+  commands = parser.add_subparsers(dest="command")
+  cmd = commands.add_parser("matching", help="loop vs vectorized key matching on every sdm/*/ej.txt")
+  cmd.add_argument("--repeat", type=int, default=200)
+  cmd = commands.add_parser("throughput", help="records/s, latency and peak RSS per source and batch size")
+  cmd.add_argument("--sources", default=",".join(SOURCES))
+  cmd.add_argument("--sizes", default="1,100,1000")
+  cmd.add_argument("--records", type=int, default=2000)
+  cmd.add_argument("--output", default="benchmark_results.json")
+  cmd = commands.add_parser("case")
+  cmd.add_argument("source")
+  cmd.add_argument("size", type=int)
+  cmd.add_argument("records", type=int)
+  args = parser.parse_args()
+
+  if args.command == "throughput":
+    throughput(args.sources.split(","), [int(size) for size in args.sizes.split(",")], args.records, args.output)
+  elif args.command == "case":
+    print(json.dumps(run_case(args.source, args.size, args.records)))
+  else:
+    matching(getattr(args, "repeat", 200))
@@ -0,0 +1,70 @@
+# Software Name: delta.py
+# SPDX-FileCopyrightText: Copyright (c) 2023 Universidad de Cantabria
+# SPDX-License-Identifier: LGPL-3.0
+#
+# This software is distributed under the LGPL-3.0 license;
+# see the LICENSE file for more details.
+#
+# Author: Victor GONZALEZ (Universidad de Cantabria) <vgonzalez@tlmat.unican.es> et al.
+
+import threading, time
+from collections import OrderedDict
+
+# members every delta keeps, so the broker knows which entity to update
+KEYS = ("id", "type", "@context")
+
+FULL = "full"
+DELTA = "delta"
+
+# an attribute without its observedAt, which changes on every record
+def content(attribute):
+  if type(attribute) != dict or "observedAt" not in attribute: return attribute
+  return {k: v for k, v in attribute.items() if k != "observedAt"}
+
+# last entity mapped for every id (LRU, at most size ids), to publish only the
+# attributes that changed since; the full entity is sent the first time an id
+# is seen and then every refresh seconds. Attributes that disappear from an
+# entity are not removed from the broker until its next full refresh
+class DeltaCache:
+  def __init__(self, size, refresh):
+    self.size = size
+    self.refresh = refresh
+    self.entries = OrderedDict() # id -> (time of the last full entity, last entity)
+    self.lock = threading.Lock()
+    self.full = 0
+    self.deltas = 0
+    self.unchanged = 0
+
+  # (FULL, entity), (DELTA, changed attributes) or None if nothing changed
+  def diff(self, medida):
+    now = time.monotonic()
+    with self.lock:
+      entry = self.entries.get(medida["id"])
+      if (entry is None) or (now - entry[0] >= self.refresh):
+        self.put(medida["id"], (now, dict(medida)))
+        self.full += 1
+        return FULL, medida
+      self.put(medida["id"], (entry[0], dict(medida)))
+
+    last = entry[1]
+    changed = {k: v for k, v in medida.items() if k not in KEYS and (k not in last or content(last[k]) != content(v))}
+    if len(changed) == 0:
+      self.unchanged += 1
+      return None
+    self.deltas += 1
+    delta = {k: medida[k] for k in KEYS if k in medida}
+    delta.update(changed)
+    return DELTA, delta
+
+  # an entity published full elsewhere, so later deltas are taken against it
+  def store(self, medida):
+    with self.lock:
+      self.put(medida["id"], (time.monotonic(), dict(medida)))
+
+  def put(self, key, entry):
+    self.entries[key] = entry
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.size: self.entries.popitem(last=False)
+
+  def stats(self):
+    return {"size": len(self.entries), "full": self.full, "delta": self.deltas, "unchanged": self.unchanged}
@@ -0,0 +1,94 @@
+# Software Name: ingest.py
+# SPDX-FileCopyrightText: Copyright (c) 2023 Universidad de Cantabria
+# SPDX-License-Identifier: LGPL-3.0
+#
+# This software is distributed under the LGPL-3.0 license;
+# see the LICENSE file for more details.
+#
+# Author: Victor GONZALEZ (Universidad de Cantabria) <vgonzalez@tlmat.unican.es> et al.
+
+import queue, threading, itertools, zlib, time, os, inspect, configparser, logging
+
+PROGRAM_NAME = inspect.stack()[0][1].split('.py', 1)[0].split('\\')[-1].split('/')[-1]
+PROGRAM_PATH = os.path.dirname(os.path.realpath(__file__))
+
+# Get variables from config file
+config = configparser.ConfigParser()
+config.read(PROGRAM_PATH + '/general.conf')
+LOG_LEVEL = config.getint('mapper','LOG_LEVEL')
+
+# Set up logger
+logger = logging.getLogger(PROGRAM_NAME + "_logger")
+formatter = logging.Formatter('{asctime} {levelname:<8s} | {filename}:{lineno:<4} [{funcName:^30s}] | {message}', style='{')
+handler = logging.StreamHandler()
+handler.setFormatter(formatter)
+handler.setLevel(LOG_LEVEL)
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(handler)
+
+# queues of mapping jobs, one per worker thread and at most size jobs between
+# them all, so HTTP requests only parse and enqueue; when they are full submit()
+# refuses the job, and the endpoints answer 429 instead of holding the
+# connection. Jobs with the same key (e.g. the updates of one entity) always go
+# to the same worker and run in the order they were accepted; jobs without a
+# key are spread round-robin
+class IngestQueue:
+  def __init__(self, workers, size):
+    self.queues = [queue.Queue() for it in range(workers)]
+    self.room = threading.Semaphore(size)
+    self.next = itertools.count()
+    self.accepted = 0
+    self.rejected = 0
+    self.threads = list()
+    for it, jobs in enumerate(self.queues):
+      thread = threading.Thread(target=self.run, args=(jobs,), name="ingest_"+str(it), daemon=True)
+      thread.start()
+      self.threads.append(thread)
+
+  def select(self, key):
+    if key is None: return self.queues[next(self.next) % len(self.queues)]
+    return self.queues[zlib.crc32(str(key).encode()) % len(self.queues)]
+
+  # queue a job without waiting, False if the queue is full
+  def submit(self, function, *args, key=None):
+    if not self.room.acquire(blocking=False):
+      self.rejected += 1
+      return False
+    self.select(key).put((function, args))
+    self.accepted += 1
+    return True
+
+  # queue a job waiting for room, for the rest of a request already accepted
+  def put(self, function, *args, key=None):
+    self.room.acquire()
+    self.select(key).put((function, args))
+    self.accepted += 1
+
+  def depth(self):
+    return sum(jobs.qsize() for jobs in self.queues)
+
+  def run(self, jobs):
+    while True:
+      function, args = jobs.get()
+      try:
+        function(*args)
+      except Exception as exception_error:
+        logger.error("Mapping job failed: "+str(exception_error))
+      finally:
+        self.room.release()
+        jobs.task_done()
+
+  # wait until every queued job has been run, at most timeout seconds;
+  # False if some are still pending
+  def join(self, timeout=None):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for jobs in self.queues:
+      with jobs.all_tasks_done:
+        while jobs.unfinished_tasks:
+          if deadline is None:
+            jobs.all_tasks_done.wait()
+            continue
+          remaining = deadline - time.monotonic()
+          if remaining <= 0: return False
+          jobs.all_tasks_done.wait(remaining)
+    return True
@@ -0,0 +1,62 @@
+# Software Name: injector.py
+# SPDX-FileCopyrightText: Copyright (c) 2023 Universidad de Cantabria
+# SPDX-License-Identifier: LGPL-3.0 
+#
+# This software is distributed under the LGPL-3.0 license;
+# see the LICENSE file for more details.
+#
+# Author: Victor GONZALEZ (Universidad de Cantabria) <vgonzalez@tlmat.unican.es> et al.
+
+import metrics
+import json, requests
+from requests.adapters import HTTPAdapter
+import os, inspect, configparser, logging
+
+PROGRAM_NAME = inspect.stack()[0][1].split('.py', 1)[0].split('\\')[-1].split('/')[-1]
+PROGRAM_PATH = os.path.dirname(os.path.realpath(__file__))
+
+# Get variables from config file
+config = configparser.ConfigParser()
+config.read(PROGRAM_PATH + '/general.conf')
+broker_address = config.get('scorpio','SCORPIO_IP')
+broker_port = config.getint('scorpio','SCORPIO_PORT')
+LOG_LEVEL = config.getint('mapper','LOG_LEVEL')
+UPSERT_CHUNK_SIZE = config.getint('mapper','UPSERT_CHUNK_SIZE',fallback=500)
+UPSERT_CONNECTIONS = config.getint('mapper','INGEST_WORKERS',fallback=8)
+
+# Set up logger
+logger = logging.getLogger(PROGRAM_NAME + "_logger")
+formatter = logging.Formatter('{asctime} {levelname:<8s} | {filename}:{lineno:<4} [{funcName:^30s}] | {message}', style='{')
+handler = logging.StreamHandler()
+handler.setFormatter(formatter)
+handler.setLevel(LOG_LEVEL)
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(handler)
+
+#scorpio_dir = "http://"+broker_address+":"+str(broker_port)+"/ngsi-ld/v1/entities/"
+scorpio_dir_upsert = "http://"+broker_address+":"+str(broker_port)+"/ngsi-ld/v1/entityOperations/upsert?options=update"
+headers_post = {
+		"Content-Type": "application/ld+json"
+	}
+
+# one session for every ingest worker, keeping a connection per worker open
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=UPSERT_CONNECTIONS))
+
+# upsert a batch of entities straight into the broker, in chunks of UPSERT_CHUNK_SIZE
+def inject_batch(medidas, tipo):
+	sc = 200
+	for it in range(0, len(medidas), UPSERT_CHUNK_SIZE):
+		chunk = medidas[it:it+UPSERT_CHUNK_SIZE]
+		with metrics.Timer("upsert", tipo, "batch"):
+			m_json = json.dumps(chunk, separators=(",",":"))
+			try: res = session.post(scorpio_dir_upsert, headers=headers_post, data=m_json)
+			except Exception as exception_error:
+				logger.error("Request to Broker failed: "+str(exception_error))
+				sc = 400
+				continue
+		if(res.status_code >= 400):
+			logger.error("HTTP "+str(res.status_code)+" when injecting batch, including "+chunk[0]["id"])
+			sc = res.status_code
+		else: logger.info("Injected batch, including "+chunk[0]["id"])
+	return sc
@@ -7,10 +7,13 @@
 #
 # Author: Victor GONZALEZ (Universidad de Cantabria) <vgonzalez@tlmat.unican.es> et al.
 
-import re, string, numpy, json, s_config, copy, jmespath, os, inspect, configparser, logging
-from prettytable import PrettyTable
+import re, string, math, numpy, json, jmespath, hashlib, glob, os, inspect, configparser, logging, threading, time
+from collections import OrderedDict, Counter, deque
 from s_jmespath import SaltedFunctions
-from sklearn.feature_extraction.text import CountVectorizer
+from new_words import NewWords
+from mapping_plans import PlanStore
+from template_compiler import compile_template
+import metrics
 
 PROGRAM_NAME = inspect.stack()[0][1].split('.py', 1)[0].split('\\')[-1].split('/')[-1]
 PROGRAM_PATH = os.path.dirname(os.path.realpath(__file__))
@@ -19,6 +22,15 @@ PROGRAM_PATH = os.path.dirname(os.path.realpath(__file__))
 config = configparser.ConfigParser()
 config.read(PROGRAM_PATH + '/general.conf')
 LOG_LEVEL = config.getint('mapper','LOG_LEVEL')
+PREDICTION_CACHE_SIZE = config.getint('mapper','PREDICTION_CACHE_SIZE',fallback=10000)
+BATCH_PLAN = config.getboolean('mapper','BATCH_PLAN',fallback=True)
+WORDS_FLUSH_INTERVAL = config.getint('mapper','WORDS_FLUSH_INTERVAL',fallback=10)
+PLANS_FILE = config.get('mapper','PLANS_FILE',fallback='files/mapping_plans.json')
+PLANS_SAVE_INTERVAL = config.getint('mapper','PLANS_SAVE_INTERVAL',fallback=60)
+PLANS_SIZE = config.getint('mapper','PLANS_SIZE',fallback=1000)
+COMPILE_TEMPLATES = config.getboolean('mapper','COMPILE_TEMPLATES',fallback=True)
+TYPE_THRESHOLD = config.getfloat('mapper','TYPE_THRESHOLD',fallback=0.15)
+DEDUP_WINDOW = config.getint('mapper','DEDUP_WINDOW',fallback=900)
 
 # Set up logger
 logger = logging.getLogger(PROGRAM_NAME + "_logger")
@@ -29,27 +41,95 @@ handler.setLevel(LOG_LEVEL)
 logger.setLevel(LOG_LEVEL)
 logger.addHandler(handler)
 
+# fields kept as they are instead of being flattened
+RAW_FIELDS = ("location", "geometry")
+
+# flatten nested dicts and lists into a single level, naming every leaf after its
+# path (e.g. properties_Ocupacion); walked with a stack, in the same order a
+# recursive depth-first walk would
 def flatten_json(y):
     out = {}
-
-    def flatten(x, name=''):
-        if type(x) is dict:
-            for a in x:
-                if (a != "location") and (a != "geometry"):
-                  flatten(x[a], name + a + '_')
+    stack = [(y, '', False)]
+    while stack:
+        x, name, raw = stack.pop()
+        if raw:
+            out[name] = x
+        elif type(x) is dict:
+            for a in reversed(x):
+                if a not in RAW_FIELDS:
+                  stack.append((x[a], name + a + '_', False))
                 else:
-                  out[name[:-1] + a] = x[a]
+                  stack.append((x[a], name[:-1] + a, True))
         elif type(x) is list:
-            i = 0
-            for a in x:
-                flatten(a, name + str(i) + '_')
-                i += 1
+            for i in range(len(x)-1, -1, -1):
+                stack.append((x[i], name + str(i) + '_', False))
         else:
             out[name[:-1]] = x
+    return out
 
-    flatten(y)
+# path plan of a record shape: the steps to get every leaf of a record with the
+# same nested keys and list lengths straight into the flattened dict, without
+# walking the record and building the key names again
+FLAT_DICT, FLAT_LIST, FLAT_LEAF, FLAT_RAW = range(4)
+
+class FlattenPlan:
+  def __init__(self, y):
+    # every step is (parent step or -1 for the record, key in the parent, kind, expected keys/length or flat key)
+    self.steps = list()
+    stack = [(-1, None, y, '', False)]
+    while stack:
+      parent, key, x, name, raw = stack.pop()
+      step = len(self.steps)
+      if raw:
+        self.steps.append((parent, key, FLAT_RAW, name))
+      elif type(x) is dict:
+        self.steps.append((parent, key, FLAT_DICT, tuple(x)))
+        for a in reversed(x):
+          if a not in RAW_FIELDS:
+            stack.append((step, a, x[a], name + a + '_', False))
+          else:
+            stack.append((step, a, x[a], name[:-1] + a, True))
+      elif type(x) is list:
+        self.steps.append((parent, key, FLAT_LIST, len(x)))
+        for i in range(len(x)-1, -1, -1):
+          stack.append((step, i, x[i], name + str(i) + '_', False))
+      else:
+        self.steps.append((parent, key, FLAT_LEAF, name[:-1]))
+    self.keys = tuple(dict.fromkeys(step[3] for step in self.steps if step[2] >= FLAT_LEAF))
+
+  # the flattened record, or None if the record does not have this shape
+  def flatten(self, y):
+    out = {}
+    values = list()
+    for parent, key, kind, expected in self.steps:
+      x = y if parent < 0 else values[parent][key]
+      values.append(x)
+      if kind == FLAT_DICT:
+        if (type(x) is not dict) or (tuple(x) != expected): return None
+      elif kind == FLAT_LIST:
+        if (type(x) is not list) or (len(x) != expected): return None
+      elif kind == FLAT_LEAF:
+        if (type(x) is dict) or (type(x) is list): return None
+        out[expected] = x
+      else:
+        out[expected] = x
     return out
 
+# recent shapes remembered per type
+FLATTEN_PLANS = 8
+flatten_plans = dict()
+
+# flatten a record with the plan of a recent record of the same shape, compiling one if
+# there is none; the flattened keys are returned too, to group records by shape
+def flatten_record(medida, tipo):
+  recent = flatten_plans.get(tipo, ())
+  for flat_plan in recent:
+    medida_flattened = flat_plan.flatten(medida)
+    if medida_flattened is not None: return medida_flattened, flat_plan.keys
+  flat_plan = FlattenPlan(medida)
+  flatten_plans[tipo] = ([flat_plan] + list(recent))[:FLATTEN_PLANS]
+  return flat_plan.flatten(medida), flat_plan.keys
+
 def json_to_text(input_data):
   data_str = json.dumps(input_data)
   lowercase = data_str.casefold()
@@ -59,177 +139,373 @@ def json_to_text(input_data):
   final = re.sub(' +', " ", spaces)
   return final
 
-def write_new_words(medida,origen,tipo):
+# word tokenization and vocabulary indexing, the same as the previously used
+# CountVectorizer(token_pattern=r"(?u)\b\w+\b") with its default options
+TOKEN_PATTERN = re.compile(r"(?u)\b\w+\b")
+
+class Vectorizer:
+  def fit(self, texts):
+    words = set()
+    for text in texts: words.update(TOKEN_PATTERN.findall(text.lower()))
+    self.vocabulary = {word: it for it, word in enumerate(sorted(words))}
+    return self
+
+  # sorted vocabulary indices of the words appearing once in the text
+  def unique_indices(self, text):
+    counts = Counter(TOKEN_PATTERN.findall(text.lower()))
+    return sorted(self.vocabulary[word] for word, n in counts.items() if (n == 1) and (word in self.vocabulary))
+
+  # unique_indices of every text as a (texts, width) matrix padded with the given value
+  def transform(self, texts, pad):
+    rows = [self.unique_indices(text) for text in texts]
+    padded = numpy.full((len(rows), max([1] + [len(row) for row in rows])), pad, dtype=numpy.int64)
+    for it, row in enumerate(rows): padded[it,:len(row)] = row
+    return padded
+
+def write_new_words(medida,model):
   # check for new words
   wordList = [field.split() for field in medida]
   wordList = sum(wordList, [])
   wordList = list(dict.fromkeys(wordList))
-  wordOrigen = "".join(origen)
-  try:
-    with open(PROGRAM_PATH + "/sdm/"+tipo+"/words.txt", "r") as file: pendingWords = file.read()
-  except:
-    pendingWords = ""
-
-  for word in wordList:
-    if word not in wordOrigen:
-      if word not in pendingWords:
-        with open(PROGRAM_PATH + "/sdm/"+tipo+"/words.txt", "a") as file: file.write(word+"\n")
-
-  return
+  wordList = [word for word in wordList if (word not in model.origen_words) and (word not in model.origen_joined)]
+  new_words.add(model.tipo, wordList)
+
+new_words = NewWords(PROGRAM_PATH + "/sdm", WORDS_FLUSH_INTERVAL)
+
+# template and dictionary files of every supported type
+SDM_FILES = {
+  "Temperature": ("temperature.template.jmespath", "Temperature/temperature.txt"),
+  "BatteryStatus": ("battery.template.jmespath", "BatteryStatus/battery.txt"),
+  "AirQualityObserved": ("airquality.template.jmespath", "AirQualityObserved/airquality.txt"),
+  "SoundPressureLevel": ("spressure.template.jmespath", "SoundPressureLevel/spressure.txt"),
+  "ParkingSpot": ("parking.template.jmespath", "ParkingSpot/parking.txt"),
+  "ElectroMagneticObserved": ("electromagnetic.template.jmespath", "ElectroMagneticObserved/electromagnetic.txt"),
+  "BikeHireDockingStation": ("bikehire.template.jmespath", "BikeHireDockingStation/bikehire.txt"),
+  "TrafficFlowObserved": ("trafficflow.template.jmespath", "TrafficFlowObserved/trafficflow.txt"),
+  "FleetVehicleStatus": ("fleet.template.jmespath", "FleetVehicleStatus/fleet.txt"),
+}
+
+# seconds between checks of the files of an already loaded type
+MODEL_CHECK_INTERVAL = 1
+
+def get_paths(tipo):
+    # get correct template
+    if tipo not in SDM_FILES:
+        raise ValueError("Type "+str(tipo)+" unknown")
+    template, origen = SDM_FILES[tipo]
+    return PROGRAM_PATH + "/templates/"+template, PROGRAM_PATH + "/sdm/"+origen
 
 def get_origen_template(tipo):
+    f_origen, f_template, _ = read_origen_template(tipo)
+    return f_origen, f_template
 
-    # get correct template
-    if (tipo=="Temperature"):
-        template = 'temperature.template.jmespath'
-        origen = 'Temperature/temperature.txt'
-    elif (tipo=="BatteryStatus"):
-        template = 'battery.template.jmespath'
-        origen = 'BatteryStatus/battery.txt'
-    elif (tipo=="AirQualityObserved"):
-        template = 'airquality.template.jmespath'
-        origen = 'AirQualityObserved/airquality.txt'
-    elif (tipo=="SoundPressureLevel"):
-        template = 'spressure.template.jmespath'
-        origen = 'SoundPressureLevel/spressure.txt'
-    elif (tipo=="ParkingSpot"):
-        template = 'parking.template.jmespath'
-        origen = 'ParkingSpot/parking.txt'
-    elif (tipo=="ElectroMagneticObserved"):
-        template = 'electromagnetic.template.jmespath'
-        origen = 'ElectroMagneticObserved/electromagnetic.txt'
-    elif (tipo=="BikeHireDockingStation"):
-        template = 'bikehire.template.jmespath'
-        origen = 'BikeHireDockingStation/bikehire.txt'
-    elif (tipo=="TrafficFlowObserved"):
-        template = 'trafficflow.template.jmespath'
-        origen = 'TrafficFlowObserved/trafficflow.txt'
-    elif (tipo=="FleetVehicleStatus"):
-        template = 'fleet.template.jmespath'
-        origen = 'FleetVehicleStatus/fleet.txt'
+# also returns a fingerprint of the contents of both files
+def read_origen_template(tipo):
+    path_template, path_origen = get_paths(tipo)
+    with open(path_template, "r") as file: f_template = file.read()
+    with open(path_origen, "r") as file: f_origen = file.read()
+    fingerprint = hashlib.sha1((f_template + "\0" + f_origen).encode()).hexdigest()
+    return json.loads(f_origen), f_template, fingerprint
+
+# fields giving the id of the records without one, from [mapper_ids]; per type
+# or the default, None with "uuid" to give them random ids
+def get_id_fields(tipo):
+  fields = config.get('mapper_ids', tipo, fallback=config.get('mapper_ids', 'default', fallback='uuid'))
+  fields = [field.strip() for field in fields.split(',') if field.strip()]
+  if fields == ["uuid"] or len(fields) == 0: return None
+  return tuple(fields)
+
+# everything the mapper needs from the files of a type, computed once
+class TypeModel:
+  def __init__(self, tipo, mtimes):
+    self.tipo = tipo
+    self.mtimes = mtimes
+    self.checked = time.monotonic()
+    self.origen, f_template, self.fingerprint = read_origen_template(tipo)
+    # python code generated from the template, or the jmespath interpreter
+    if COMPILE_TEMPLATES: self.template = compile_template(f_template)
+    else: self.template = jmespath.compile(f_template)
+    self.id_fields = get_id_fields(tipo)
+
+    origen_fields = [{k:v} for k,v in self.origen.items()]
+    self.origen_text = [json_to_text(field) for field in origen_fields]
+    self.origen_joined = "".join(self.origen_text)
+    self.origen_words = set(self.origen_joined.split())
+    train_text = self.origen_text[:-1] #remove the "nocategory" words for computation
+
+    # create the transform, tokenize and build vocab
+    self.vectorizer = Vectorizer().fit(train_text)
+    self.train_vecs = self.vectorizer.transform(train_text, TRAIN_PAD)
+    self.train_labels = [k for k,v in self.origen.items()]
+
+models = dict()
+models_lock = threading.Lock()
+# bumped every time a model is (re)built, so the classifier knows when to rebuild
+models_version = 0
+
+def get_mtimes(tipo):
+  return tuple(os.stat(path).st_mtime_ns for path in get_paths(tipo))
+
+# get the cached model of a type, (re)loading it when its files change on disk
+# None, logging it, for types without files
+def get_model(tipo):
+  global models_version
+  model = models.get(tipo)
+  if (model is None) and (tipo not in SDM_FILES):
+    logger.error("Type "+str(tipo)+" unknown")
+    return None
+  now = time.monotonic()
+  if (model is not None) and (now - model.checked < MODEL_CHECK_INTERVAL): return model
+
+  mtimes = get_mtimes(tipo)
+  if (model is not None) and (model.mtimes == mtimes):
+    model.checked = now
+    return model
+
+  with models_lock:
+    model = models.get(tipo)
+    if (model is None) or (model.mtimes != mtimes):
+      if model is not None:
+        logger.info("Reloading "+tipo+" model")
+        prediction_cache.clear()
+      model = TypeModel(tipo, mtimes)
+      models[tipo] = model
+      models_version += 1
+  return model
+
+# type of the records without type-tag-salted, from the words of the dictionaries of
+# every type: an inverted index gives the types using every word with its idf, so a
+# record is scored against all types at once, in time proportional to its words.
+# The score is the cosine between the idf weighted words of the record and of the
+# type, over the words known to any type; records under the threshold are rejected
+class TypeClassifier:
+  def __init__(self, models, threshold, version):
+    self.threshold = threshold
+    self.version = version
+    # nocategory included, since it lists the values typical of every type
+    words = {tipo: set(TOKEN_PATTERN.findall(model.origen_joined)) for tipo, model in models.items()}
+    types = dict() # word -> types using it
+    for tipo, type_words in words.items():
+      for word in type_words: types.setdefault(word, list()).append(tipo)
+    self.idf = {word: math.log(len(words) / len(word_types)) ** 2 for word, word_types in types.items()}
+    norms = {tipo: math.sqrt(sum(self.idf[word] for word in type_words)) or 1.0 for tipo, type_words in words.items()}
+    self.index = {word: [(tipo, self.idf[word] / norms[tipo]) for tipo in word_types] for word, word_types in types.items() if self.idf[word] > 0}
+    self.predicted = 0
+    self.rejected = 0
+
+  # (type, score), the type None if no type reaches the threshold
+  def classify(self, medida):
+    scores = dict()
+    norm = 0.0
+    for word in set(TOKEN_PATTERN.findall(json_to_text(medida))):
+      norm += self.idf.get(word, 0.0)
+      for tipo, weight in self.index.get(word, ()): scores[tipo] = scores.get(tipo, 0.0) + weight
+    if len(scores) == 0:
+      self.rejected += 1
+      return None, 0.0
+    tipo = max(scores, key=scores.get)
+    score = scores[tipo] / math.sqrt(norm)
+    if score < self.threshold:
+      self.rejected += 1
+      return None, score
+    self.predicted += 1
+    return tipo, score
+
+  def stats(self):
+    return {"predicted": self.predicted, "rejected": self.rejected}
+
+classifier = None
+classifier_lock = threading.Lock()
+classifier_checked = 0.0
+
+# rebuilt when any model is (re)built; the files of every type are checked at most
+# once per MODEL_CHECK_INTERVAL, not on every record
+def get_classifier():
+  global classifier, classifier_checked
+  now = time.monotonic()
+  if now - classifier_checked >= MODEL_CHECK_INTERVAL:
+    classifier_checked = now
+    for tipo in SDM_FILES: get_model(tipo)
+  if (classifier is not None) and (classifier.version == models_version): return classifier
+  with classifier_lock:
+    if (classifier is None) or (classifier.version != models_version):
+      # a model reloaded while building bumps the version again, rebuilding it next time
+      version = models_version
+      classifier = TypeClassifier({tipo: get_model(tipo) for tipo in SDM_FILES}, TYPE_THRESHOLD, version)
+  return classifier
+
+# type of a record without type-tag-salted, None if it does not look like any
+def predict_type(medida, mode="stream"):
+  with metrics.Timer("classify", None, mode):
+    tipo, score = get_classifier().classify(medida)
+  if tipo is None: logger.error("Record of unknown type, best score "+str(round(score, 3)))
+  else: logger.debug("Predicted type "+tipo+" with score "+str(round(score, 3)))
+  return tipo
+
+metrics.register_gauge("mapper_type_inference", "Records whose type was predicted or rejected",
+  lambda: {("result", k): v for k,v in (classifier.stats() if classifier is not None else {"predicted": 0, "rejected": 0}).items()})
+
+# bounded LRU cache of field predictions, keyed by (type, field text)
+class PredictionCache:
+  def __init__(self, size):
+    self.size = size
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key):
+    with self.lock:
+      prediction = self.entries.get(key)
+      if prediction is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+        self.entries.move_to_end(key)
+      return prediction
+
+  def put(self, key, prediction):
+    if self.size <= 0: return
+    with self.lock:
+      self.entries[key] = prediction
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+  def clear(self):
+    with self.lock: self.entries.clear()
+
+  def stats(self):
+    return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+prediction_cache = PredictionCache(PREDICTION_CACHE_SIZE)
+metrics.register_gauge("mapper_prediction_cache", "Size and hit, miss and eviction counters of the prediction cache",
+  lambda: {("counter", k): v for k,v in prediction_cache.stats().items()})
+
+# paddings far enough from each other and from any vocabulary index
+TEST_PAD = -(1 << 40)
+TRAIN_PAD = 1 << 40
+MAX_DIST = 1000 #"infinite"
+
+# predict the SDM key of every field as (key, distance, counts, likelihood)
+def match_fields(model, medida_text, mode="stream"):
+  with metrics.Timer("vectorize", model.tipo, mode):
+    test_vecs = model.vectorizer.transform(medida_text, TEST_PAD)
+  start = time.perf_counter()
+  train_vecs = model.train_vecs
+
+  # distance between every test token and every train token of every (test field, train field) pair;
+  # then the minimum distance and the number of token pairs achieving it
+  dist = numpy.abs(test_vecs[:,None,:,None] - train_vecs[None,:,None,:])
+  min_dist = numpy.minimum(dist.min(axis=(2,3)), MAX_DIST)
+  counts = (dist == min_dist[:,:,None,None]).sum(axis=(2,3))
+  min_dist = min_dist.astype(numpy.float64)
+  counts = counts.astype(numpy.float64)
+
+  # sort by distance, keep the train fields at the minimum distance and take the one with more counts
+  distIndex = numpy.argsort(min_dist, axis=1) # sorting distance and returning indices that achieves sort
+  dist_ordenada = numpy.take_along_axis(min_dist, distIndex, axis=1)
+  count_ordenada = numpy.take_along_axis(counts, distIndex, axis=1)
+  numMin = (dist_ordenada == dist_ordenada[:,:1]).sum(axis=1)
+
+  train_labels = model.train_labels
+  predictions = list()
+  for it_test in range(len(medida_text)):
+    if numMin[it_test] == 1:
+      best = 0
+    else:
+      best = numpy.argsort(count_ordenada[it_test,:numMin[it_test]])[-1]
+    finalIndex = distIndex[it_test,best]
+    final_dist = dist_ordenada[it_test,best]
+    final_counts = count_ordenada[it_test,best]
+    if (final_dist != 0):
+      verosimilitud = 0
     else:
-        logger.error("Type "+tipo+" unknown")
-        exit()
+      if (final_counts == 1):
+        verosimilitud = 1
+      elif (final_counts == 2):
+        verosimilitud = 2
+      else:
+        verosimilitud = 3
 
-    with open(PROGRAM_PATH + "/templates/"+template, "r") as file: f_template = file.read()
-    with open(PROGRAM_PATH + "/sdm/"+origen, "r") as file: f_origen = json.loads(file.read())
-    return f_origen, f_template
+    predictions.append((train_labels[finalIndex], final_dist, final_counts, verosimilitud))
 
-def mapper(medida, tipo, unitData):
-  origen, template = get_origen_template(tipo)
+  metrics.observe("match", model.tipo, mode, time.perf_counter() - start)
+  return predictions
 
-  origen_fields = [{k:v} for k,v in origen.items()]
-  origen_text = [json_to_text(field) for field in origen_fields]
+# same as match_fields, but only computing the fields that are not cached
+def predict_fields(model, medida_text, mode="stream"):
+  predictions = [prediction_cache.get((model.tipo, text)) for text in medida_text]
+  missing = [it for it in range(len(predictions)) if predictions[it] is None]
+  if len(missing) == 0: return predictions
 
-  medida_flattened = flatten_json(medida)
+  computed = match_fields(model, [medida_text[it] for it in missing], mode)
+  for it, prediction in zip(missing, computed):
+    prediction_cache.put((model.tipo, medida_text[it]), prediction)
+    predictions[it] = prediction
+  return predictions
+
+# predict the new key of every flattened field; the plan is the list of
+# (field, new key) renames in likelihood order (3,2,1)
+def infer_plan(model, medida_flattened, mode="stream"):
   medida_fields = [{k:v} for k,v in medida_flattened.items()]
   medida_text = [json_to_text(field) for field in medida_fields]
 
-  write_new_words(medida_text,origen_text,tipo) #save new words
-  origen_text.pop() #remove the "nocategory" words for computation
-
-  # create the transform
-  vectorizer = CountVectorizer(token_pattern=r"(?u)\b\w+\b")
-  # tokenize and build vocab
-  vectorizer.fit(origen_text)
-
-  origen_vec = vectorizer.transform(origen_text).toarray()
-  train_vecs = list()
-  for vec_field in origen_vec:
-    train_vecs.append(list(numpy.where(vec_field == 1)[0]))
+  write_new_words(medida_text,model) #save new words
 
-  medida_vec = vectorizer.transform(medida_text).toarray()
-  test_vecs = list()
-  for vec_field in medida_vec:
-    test_vecs.append(list(numpy.where(vec_field == 1)[0]))
-
-  train_labels = [k for k,v in origen.items()]
-  numTrainVecs = len(train_vecs)
-  numTestVecs = len(test_vecs)
-
-  final_keys = numpy.array([])
-  distancia = list()
-  cuentas = list()
-  verosimilitud = list()
+  predictions = predict_fields(model, medida_text, mode)
+  final_keys = [prediction[0] for prediction in predictions]
+  distancia = [prediction[1] for prediction in predictions]
+  cuentas = [prediction[2] for prediction in predictions]
+  verosimilitud = [prediction[3] for prediction in predictions]
   nombres = ["Baja","Media","Alta","Muy alta"]
-  for it_test in range(0,numTestVecs):
-    arrayNewDist = [numpy.array([]),numpy.array([])]
-    
-    for it_train in range(numTrainVecs):
-      min_dist = 1000 #"infinite"
-      count = 0
-      for elem in train_vecs[it_train]:
-        for elem2 in test_vecs[it_test]:
-          dist = abs(elem - elem2)
-          if dist < min_dist:
-            min_dist = dist
-            count = 1
-          elif dist == min_dist:
-            count += 1
-
-      arrayNewDist[0] = numpy.append(arrayNewDist[0], min_dist)
-      arrayNewDist[1] = numpy.append(arrayNewDist[1], count)
-
-    distIndex = numpy.argsort(arrayNewDist[0]) # sorting distance and returning indices that achieves sort
-    dist_ordenada = numpy.take(arrayNewDist[0], distIndex)
-    count_ordenada = numpy.take(arrayNewDist[1], distIndex)
-    distancia_min = dist_ordenada[0]
-    for it_dist in range(len(dist_ordenada)):
-      if (dist_ordenada[it_dist] > distancia_min):
-        dist_ordenada = dist_ordenada[0:it_dist]
-        count_ordenada = count_ordenada[0:it_dist]
-        break
-    
-    countIndex = numpy.argsort(count_ordenada)
-    finalIndex = distIndex[countIndex[-1]]
-    final_dist = dist_ordenada[countIndex[-1]]
-    final_counts = count_ordenada[countIndex[-1]]
-    distancia.append(final_dist)
-    cuentas.append(final_counts)
-    if (final_dist != 0):
-      verosimilitud.append(0)
-    else:
-      if (final_counts == 1):
-        verosimilitud.append(1)
-      elif (final_counts == 2):
-        verosimilitud.append(2)
-      else:
-        verosimilitud.append(3)
-
-    label = train_labels[finalIndex]
-    final_keys = numpy.append(final_keys, label)
 
   # Print all
-  table = PrettyTable(["Campo","Tipo predicho","Distancia","Cuentas","Verosimilitud"])
-  for index in range(len(test_vecs)):
-    table.add_row([medida_text[index],final_keys[index],distancia[index],cuentas[index],nombres[verosimilitud[index]]])
-  logger.debug(table)
+  if logger.isEnabledFor(logging.DEBUG):
+    from prettytable import PrettyTable
+    table = PrettyTable(["Campo","Tipo predicho","Distancia","Cuentas","Verosimilitud"])
+    for index in range(len(medida_text)):
+      table.add_row([medida_text[index],final_keys[index],distancia[index],cuentas[index],nombres[verosimilitud[index]]])
+    logger.debug(table)
 
-  # change the json keys to the predicted ones in likelihood order (3,2,1)
   veroIndex = numpy.argsort(verosimilitud)
   veroIndex = numpy.flip(veroIndex)
-  keys = list(medida_flattened.items())
+  keys = list(medida_flattened.keys())
+  plan = list()
+  newKeys = set()
+  for it in veroIndex:
+    if (verosimilitud[it] == 0): break
+    newKey = final_keys[it]
+    if (newKey in newKeys): continue
+    newKeys.add(newKey)
+    plan.append((keys[it], newKey))
+  return plan
+
+# change the json keys to the predicted ones
+def apply_plan(plan, medida_flattened, unitData):
   if isinstance(unitData, dict):
     unitData = flatten_json(unitData)
   medida_mapped = dict()
   medida_mapped["unitDataSalted"] = dict()
-  for it in veroIndex:
-    if (verosimilitud[it] == 0): break
-    newKey = final_keys[it]
-    if (newKey in medida_mapped): continue
-    medida_mapped[newKey] = medida_flattened[keys[it][0]]
+  for key, newKey in plan:
+    medida_mapped[newKey] = medida_flattened[key]
     try:
-      medida_mapped["unitDataSalted"][newKey] = unitData[keys[it][0]]
+      medida_mapped["unitDataSalted"][newKey] = unitData[key]
     except:
       continue
+  return medida_mapped
 
-  s_config.medida = copy.deepcopy(medida_mapped)
-
-  # use the template
-  options = jmespath.Options(custom_functions=SaltedFunctions())
-  medida_ngsild = jmespath.search(template, medida_mapped, options=options)
+# build the NGSI-LD entity from the mapped record
+def render(model, medida_mapped, mode="stream"):
+  # use the template; the custom functions get the record through their own instance
+  with metrics.Timer("template", model.tipo, mode):
+    options = jmespath.Options(custom_functions=SaltedFunctions(medida_mapped, model.id_fields))
+    medida_ngsild = model.template.search(medida_mapped, options=options)
 
   # remove empty properties
+  start = time.perf_counter()
   to_delete = list()
   for k,v in medida_ngsild.items():
     if not hasattr(v, "__getitem__"): continue
@@ -243,9 +519,143 @@ def mapper(medida, tipo, unitData):
       if v["unitCode"] == None:
         del medida_ngsild[k]["unitCode"]
   for k in to_delete: del medida_ngsild[k]
+  metrics.observe("prune", model.tipo, mode, time.perf_counter() - start)
 
   return medida_ngsild
 
+# (type, id, date) of the records mapped in the last window seconds, to drop
+# the repeated notifications and the polls of sources that did not update; 0 disables it
+class DedupWindow:
+  def __init__(self, window):
+    self.window = window
+    self.seen = dict() # key -> time it was first seen
+    self.order = deque() # (time, key), oldest first
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  # True if the key was seen within the window, remembering it otherwise
+  def check(self, key):
+    if (self.window <= 0) or (key is None): return False
+    now = time.monotonic()
+    with self.lock:
+      while (len(self.order) > 0) and (now - self.order[0][0] >= self.window):
+        seen, old = self.order.popleft()
+        if self.seen.get(old) == seen: del self.seen[old]
+      if key in self.seen:
+        self.hits += 1
+        return True
+      self.seen[key] = now
+      self.order.append((now, key))
+      self.misses += 1
+      return False
+
+  def clear(self):
+    with self.lock:
+      self.seen.clear()
+      self.order.clear()
+
+  def stats(self):
+    total = self.hits + self.misses
+    return {"size": len(self.seen), "hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / total, 4) if total else 0}
+
+dedup_window = DedupWindow(DEDUP_WINDOW)
+metrics.register_gauge("mapper_dedup_window", "Size, hit and miss counters and hit rate of the window of recently mapped records",
+  lambda: {("counter", k): v for k,v in dedup_window.stats().items()})
+
+# the same id and date the template will give the record, None if any of them
+# would be made up (random id, current date). Without an id of the source only
+# records with every identity field are deduplicated, otherwise two sensors
+# sharing some of the fields at the same time would be taken as one record
+def dedup_key(model, medida_mapped):
+  if medida_mapped.get("id") is not None: identity = str(medida_mapped["id"])
+  else: identity = SaltedFunctions(medida_mapped, model.id_fields).stable_id(model.tipo)
+  if identity is None: return None
+  if "dateObserved" in medida_mapped: date = medida_mapped["dateObserved"]
+  elif "dateModified" in medida_mapped: date = medida_mapped["dateModified"]
+  else: return None
+  return (model.tipo, identity, str(date))
+
+# (dedup key, entity) of a record, None if the type is unknown or the record was
+# already mapped within the given dedup window. Every stream record is predicted on
+# its own, since the field values take part in the prediction; only the prediction
+# cache is reused, plans are for batches. The workers of a MappingPool get no window
+# and return the keys, so the duplicates are filtered by the single window of the parent
+def mapper_keyed(medida, tipo, unitData, mode="stream", window=None):
+  model = get_model(tipo)
+  if model is None: return None
+  with metrics.Timer("flatten", tipo, mode):
+    medida_flattened, _ = flatten_record(medida, tipo)
+  plan = infer_plan(model, medida_flattened, mode)
+  medida_mapped = apply_plan(plan, medida_flattened, unitData)
+  key = dedup_key(model, medida_mapped)
+  if (window is not None) and window.check(key): return None
+  return key, render(model, medida_mapped, mode)
+
+# None if the type is unknown or the record was already mapped within the dedup window
+def mapper(medida, tipo, unitData, mode="stream"):
+  result = mapper_keyed(medida, tipo, unitData, mode, dedup_window)
+  if result is None: return None
+  return result[1]
+
+plan_store = PlanStore((PROGRAM_PATH + "/" + PLANS_FILE) if PLANS_FILE else None, PLANS_SAVE_INTERVAL, PLANS_SIZE)
+
+# map a batch of records of the same type into (dedup key, entity) pairs; the plan
+# is inferred once for every set of flattened keys (usually a single one per source)
+# and then reused by later records and batches, unless BATCH_PLAN is disabled and
+# every record is predicted on its own; empty if the type is unknown, and without
+# the records already mapped within the given dedup window
+def mapper_batch_keyed(medidas, tipo, unitDatas, window=None):
+  model = get_model(tipo)
+  if model is None: return list()
+  if not BATCH_PLAN:
+    medidas_final = [mapper_keyed(medida, tipo, unitData, "batch", window) for medida, unitData in zip(medidas, unitDatas)]
+    return [medida for medida in medidas_final if medida is not None]
+
+  shapes = set()
+  medidas_final = list()
+  for medida, unitData in zip(medidas, unitDatas):
+    with metrics.Timer("flatten", tipo, "batch"):
+      medida_flattened, keys = flatten_record(medida, tipo)
+    shapes.add(keys)
+    plan = plan_store.get(model, keys)
+    if plan is None:
+      plan = infer_plan(model, medida_flattened, "batch")
+      plan_store.put(model, keys, plan)
+    else:
+      # the values of every record may bring new words, not only its shape
+      write_new_words([json_to_text({k:v}) for k,v in medida_flattened.items()], model)
+    medida_mapped = apply_plan(plan, medida_flattened, unitData)
+    key = dedup_key(model, medida_mapped)
+    if (window is not None) and window.check(key): continue
+    medidas_final.append((key, render(model, medida_mapped, "batch")))
+  if len(shapes) > 1: logger.info("Batch of "+tipo+" with "+str(len(shapes))+" different shapes")
+  return medidas_final
+
+# the entities of a batch of records of the same type, see mapper_batch_keyed
+def mapper_batch(medidas, tipo, unitDatas):
+  return [medida for _, medida in mapper_batch_keyed(medidas, tipo, unitDatas, dedup_window)]
+
+# load the saved plans and map the example of every type, so the first requests
+# find the models, caches and plans ready; the saved plans only warm up batches,
+# stream records are predicted field by field and start from the examples alone
+def prewarm():
+  plan_store.load()
+  # the examples are not real records, neither new words nor duplicates to drop
+  new_words.paused = True
+  try:
+    for path in sorted(glob.glob(PROGRAM_PATH + "/sdm/*/ej.txt")):
+      tipo = path.split("/")[-2]
+      if tipo not in SDM_FILES: continue
+      with open(path, "r") as f: medida = json.loads(f.read())
+      mapper(medida, tipo, None)
+      dedup_window.clear()
+      mapper_batch([medida], tipo, [None])
+  finally:
+    new_words.paused = False
+  dedup_window.clear()
+  get_classifier()
+  logger.info("Prewarmed "+str(len(models))+" types")
 
 if __name__ == '__main__':
   tipo_test = "TrafficFlowObserved"
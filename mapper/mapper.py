@@ -9,10 +9,14 @@
 #
 # Author: Victor GONZALEZ (Universidad de Cantabria) <vgonzalez@tlmat.unican.es> et al.
 
-import map_fields
-import json, waitress
-import configparser, os, logging, inspect, signal
-from flask import Flask, request
+import map_fields, metrics, check_errors, injector
+from publisher import Publisher
+from mapping_pool import MappingPool
+from ingest import IngestQueue
+from delta import DeltaCache, DELTA
+import json, waitress, time
+import configparser, os, sys, logging, inspect, signal
+from flask import Flask, request, Response
 from flask_restful import Api, Resource
 import paho.mqtt.client as mqtt
 
@@ -27,6 +31,24 @@ mqtt_address = config.get('scorpio','MQTT_IP')
 mapper_address = config.get('scorpio','MAPPER_IP')
 mapper_port = config.getint('scorpio','MAPPER_PORT')
 LOG_LEVEL = config.getint('mapper','LOG_LEVEL')
+PUBLISH_CHUNK_SIZE = config.getint('mapper','PUBLISH_CHUNK_SIZE',fallback=500)
+PUBLISH_WINDOW = config.getint('mapper','PUBLISH_WINDOW',fallback=20)
+PUBLISH_QUEUE_SIZE = config.getint('mapper','PUBLISH_QUEUE_SIZE',fallback=1000)
+PAYLOAD_ENCODING = config.get('mapper','PAYLOAD_ENCODING',fallback='json')
+SHARDS = config.getint('mapper','SHARDS',fallback=0)
+NDJSON_TYPES = ("application/x-ndjson", "application/jsonl")
+MAPPER_WORKERS = config.getint('mapper','WORKERS',fallback=0)
+WORKER_CHUNK_SIZE = config.getint('mapper','WORKER_CHUNK_SIZE',fallback=200)
+INGEST_QUEUE_SIZE = config.getint('mapper','INGEST_QUEUE_SIZE',fallback=1000)
+INGEST_WORKERS = config.getint('mapper','INGEST_WORKERS',fallback=8)
+INGEST_CHUNK_SIZE = config.getint('mapper','INGEST_CHUNK_SIZE',fallback=500)
+RETRY_AFTER = config.getint('mapper','RETRY_AFTER',fallback=1)
+SHUTDOWN_TIMEOUT = config.getint('mapper','SHUTDOWN_TIMEOUT',fallback=8)
+SERVER = config.get('mapper','SERVER',fallback='waitress')
+DIRECT_UPSERT = config.getboolean('mapper','DIRECT_UPSERT',fallback=False)
+DELTA_TYPES = [tipo.strip() for tipo in config.get('mapper','DELTA_TYPES',fallback='').split(',') if tipo.strip()]
+DELTA_CACHE_SIZE = config.getint('mapper','DELTA_CACHE_SIZE',fallback=100000)
+FULL_REFRESH = config.getint('mapper','FULL_REFRESH',fallback=3600)
 
 # Set up logger
 logger = logging.getLogger(PROGRAM_NAME + "_logger")
@@ -40,81 +62,243 @@ logger.addHandler(handler)
 app = Flask(__name__, static_url_path="")
 api = Api(app)
 
+# map in the waitress threads, or in a pool of processes if WORKERS > 0
+backend = map_fields
+
+# entities of DELTA_TYPES in batches are published as the attributes that changed
+# since the last one. Stream entities are always published full, since the curator
+# needs the whole entity to assess its quality
+delta_cache = DeltaCache(DELTA_CACHE_SIZE, FULL_REFRESH)
+if len(DELTA_TYPES) > 0:
+  metrics.register_gauge("mapper_delta_cache", "Size of the delta cache and entities published full, as delta or not at all",
+    lambda: {("counter", k): v for k,v in delta_cache.stats().items()})
+
+# requests were already answered with 202, so map and send what is queued before
+# disconnecting, for at most SHUTDOWN_TIMEOUT seconds
 def exit_gracefully(signal, _):
+  deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+  try:
+    if not ingest.join(SHUTDOWN_TIMEOUT): logger.warning("Dropping "+str(ingest.depth())+" queued mapping jobs")
+    if not publisher.join(max(0, deadline - time.monotonic())): logger.warning("Dropping unsent messages")
+  except NameError: pass
   try: client.disconnect()
   except: pass
+  if backend is not map_fields: backend.shutdown()
+  map_fields.new_words.flush()
+  map_fields.plan_store.save()
   logger.info("Gracefully stopped")
   exit(0)
 
 signal.signal(signal.SIGINT, exit_gracefully)
 signal.signal(signal.SIGTERM, exit_gracefully)
 
+# answer of the endpoints when the ingest queue is full
+def too_many_requests():
+  return {"message": "Mapper busy, retry later"}, 429, {"Retry-After": str(RETRY_AFTER)}
+
+# map a single record of the given type, or of the predicted one if None, and publish it
+def map_stream(medida, tipo):
+  if tipo is None: tipo = map_fields.predict_type(medida, "stream")
+  if tipo is None: return
+
+  # check if there is info about the units
+  if "unit-data-salted" in medida:
+    unitData = medida["unit-data-salted"]
+    del medida["unit-data-salted"]
+  else:
+    unitData = None
+  
+  # map every field based on type
+  medida_final = backend.mapper(medida,tipo,unitData,"stream")
+  if medida_final is None: return
+  
+  logger.info("Mapped "+medida_final["id"])
+  if tipo in DELTA_TYPES: delta_cache.store(medida_final)
+  publisher.publish_stream(tipo,medida_final)
+
+# type-tag-salted as a metrics label before it is validated, so made-up types
+# do not create new series
+def label_type(tipo):
+  if (tipo is None) or (type(tipo) == str and tipo in map_fields.SDM_FILES): return tipo
+  return "unknown"
+
+# parse a record and queue it for mapping, False if the ingest queue is full
+def queue_stream(data):
+  # get data
+  start = time.perf_counter()
+  medida = json.loads(data)
+
+  # get or predict type
+  if "type-tag-salted" in medida:
+    tipo = medida["type-tag-salted"]
+    del medida["type-tag-salted"]
+  else:
+    tipo = None
+  metrics.observe("parse", label_type(tipo), "stream", time.perf_counter() - start)
+
+  return ingest.submit(map_stream, medida, tipo, key=ordering_key(medida, tipo))
+
+# the updates of an entity are mapped by the same ingest worker, keeping their order:
+# keyed by the id of the source record, or by its type when it has none
+def ordering_key(medida, tipo):
+  for field in ("id", "urn"):
+    if medida.get(field) is not None: return medida[field]
+  return tipo
+
 class UC_mapper_stream(Resource):
   def post(self):
-    # get data
     request.get_data()
-    medida = json.loads(request.data)
+    if not queue_stream(request.data): return too_many_requests()
+    return None, 202
+    
+# same checks the curator applies to batches, skipping the entities they fail on
+def check_batch(medidas, tipo, partial=False):
+  medidas_checked = list()
+  for medida in medidas:
+    try:
+      medidas_checked.append(check_errors.check(medida,tipo,partial)[0])
+    except Exception as exception_error:
+      logger.error("Could not check "+str(medida.get("id"))+": "+str(exception_error))
+  return medidas_checked
+
+# map a list of records of the given type and publish them
+def map_group(medidas, tipo):
+  unitDatas = list()
+  for medida in medidas:
+    # check if there is info about the units
+    if "unit-data-salted" in medida:
+      unitDatas.append(medida["unit-data-salted"])
+      del medida["unit-data-salted"]
+    else:
+      unitDatas.append(None)
+    
+  # map every field based on type
+  medidas_final = backend.mapper_batch(medidas,tipo,unitDatas)
+  
+  # send data to scorpio, through the curator or straight into the broker
+  if len(medidas_final) == 0: return
+  logger.info("Mapped batch of "+tipo)
+  medidas_delta = list()
+  if tipo in DELTA_TYPES: medidas_final, medidas_delta = split_deltas(medidas_final)
+  if DIRECT_UPSERT:
+    with metrics.Timer("check", tipo, "batch"):
+      medidas_final = check_batch(medidas_final, tipo) + check_batch(medidas_delta, tipo, True)
+    if len(medidas_final) > 0: injector.inject_batch(medidas_final, tipo)
+  else:
+    if len(medidas_final) > 0: publisher.publish_batch(tipo,medidas_final)
+    if len(medidas_delta) > 0: publisher.publish_batch(tipo,medidas_delta,"delta")
+
+# full entities and deltas of a batch, leaving out the entities that did not change
+def split_deltas(medidas):
+  medidas_full = list()
+  medidas_delta = list()
+  for medida in medidas:
+    result = delta_cache.diff(medida)
+    if result is None: continue
+    if result[0] == DELTA: medidas_delta.append(result[1])
+    else: medidas_full.append(result[1])
+  return medidas_full, medidas_delta
 
+# map a list of records of any types, every type on its own and published on its own topic;
+# records without type-tag-salted get the predicted one, and are skipped if there is none
+def map_batch(medidas):
+  groups = dict()
+  for medida in medidas:
     # get or predict type
     if "type-tag-salted" in medida:
       tipo = medida["type-tag-salted"]
       del medida["type-tag-salted"]
     else:
-      tipo = None
+      tipo = map_fields.predict_type(medida, "batch")
+      if tipo is None: continue
+    groups.setdefault(tipo, list()).append(medida)
+
+  # a failing type does not stop the others
+  for tipo, group in groups.items():
+    try:
+      map_group(group, tipo)
+    except Exception as exception_error:
+      logger.error("Could not map batch of "+str(tipo)+": "+str(exception_error))
+
+# parse a list of records and queue them for mapping, False if the ingest queue is full
+def queue_batch(data):
+  # get data
+  start = time.perf_counter()
+  medidas = json.loads(data)
+  if len(medidas) == 0: return True
+  
+  # the parsing time is accounted to the type of the first record
+  tipo = medidas[0].get("type-tag-salted")
+  metrics.observe("parse", label_type(tipo), "batch", time.perf_counter() - start)
+      
+  return ingest.submit(map_batch, medidas)
+
+# queue a chunk of a NDJSON batch; only the first chunk can be refused, the
+# rest wait for room in the queue
+def queue_chunk(medidas, accepted):
+  if not accepted: return ingest.submit(map_batch, medidas)
+  ingest.put(map_batch, medidas)
+  return True
+
+# parse a NDJSON line; the parsing time is accounted to the type of the first record
+def parse_line(line, tipo):
+  medida = json.loads(line)
+  if tipo is None: tipo = medida.get("type-tag-salted")
+  return medida, tipo
 
-    # check if there is info about the units
-    if "unit-data-salted" in medida:
-      unitData = medida["unit-data-salted"]
-      del medida["unit-data-salted"]
-    else:
-      unitData = None
-    
-    # map every field based on type
-    medida_final = map_fields.mapper(medida,tipo,unitData)
-    
-    logger.info("Mapped "+medida_final["id"])
-    medida_final = json.dumps(medida_final)
-    msg_info = client.publish(tipo+"/stream",medida_final)
-    msg_info.wait_for_publish()
-    
 class UC_mapper_batch(Resource):
   def post(self):
-    # get data
+    if request.mimetype in NDJSON_TYPES: return self.post_ndjson()
     request.get_data()
-    medidas = json.loads(request.data)
-    if len(medidas) == 0: return
-    medidas_final = list()
-    
-    # get or predict type; only once since it's assumed they all belong to the same type
-    if "type-tag-salted" in medidas[0]: tipo = medidas[0]["type-tag-salted"]
-    else: tipo = None
-        
-    for medida in medidas:
-      if "type-tag-salted" in medida: del medida["type-tag-salted"]
-      # check if there is info about the units
-      if "unit-data-salted" in medida:
-        unitData = medida["unit-data-salted"]
-        del medida["unit-data-salted"]
-      else:
-        unitData = None
-      
-      # map every field based on type
-      medida_final = map_fields.mapper(medida,tipo,unitData)
-      medidas_final.append(medida_final)
-    
-    # send data to scorpio
-    if len(medidas_final) == 0: return
-    logger.info("Mapped batch")
-    medidas_final = json.dumps(medidas_final,indent=3)
-    msg_info = client.publish(tipo+"/batch",medidas_final)
-    msg_info.wait_for_publish()
+    if not queue_batch(request.data): return too_many_requests()
+    return None, 202
+
+  # one record per line, queued in chunks while the request is read
+  def post_ndjson(self):
+    tipo = None
+    medidas = list()
+    accepted = False
+    start = time.perf_counter()
+    for line in request.stream:
+      if len(line.strip()) == 0: continue
+      medida, tipo = parse_line(line, tipo)
+      medidas.append(medida)
+      if len(medidas) == INGEST_CHUNK_SIZE:
+        metrics.observe("parse", label_type(tipo), "batch", time.perf_counter() - start)
+        if not queue_chunk(medidas, accepted): return too_many_requests()
+        accepted = True
+        medidas = list()
+        start = time.perf_counter()
+    if len(medidas) > 0:
+      metrics.observe("parse", label_type(tipo), "batch", time.perf_counter() - start)
+      if not queue_chunk(medidas, accepted): return too_many_requests()
+    return None, 202
+
+class UC_mapper_metrics(Resource):
+  def get(self):
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 api.add_resource(UC_mapper_stream, '/UCmapper_stream', endpoint='UC_mapper_stream')
 api.add_resource(UC_mapper_batch, '/UCmapper_batch', endpoint='UC_mapper_batch')
+api.add_resource(UC_mapper_metrics, '/metrics', endpoint='UC_mapper_metrics')
 
 if __name__ == '__main__':
+  map_fields.prewarm()
   client = mqtt.Client(client_id="salted_mapper")
   client.connect(mqtt_address,1883,0)
-  waitress.serve(app, host=mapper_address, port=mapper_port, _quiet=True, threads=8, connection_limit=1000, cleanup_interval=10, channel_timeout=10)
+  client.loop_start()
+  publisher = Publisher(client, PUBLISH_CHUNK_SIZE, PUBLISH_WINDOW, PUBLISH_QUEUE_SIZE, PAYLOAD_ENCODING, SHARDS)
+  if MAPPER_WORKERS > 0: backend = MappingPool(MAPPER_WORKERS, WORKER_CHUNK_SIZE)
+  ingest = IngestQueue(INGEST_WORKERS, INGEST_QUEUE_SIZE)
+  metrics.register_gauge("mapper_ingest_queue_depth", "Mapping jobs waiting in the ingest queue", ingest.depth)
+  metrics.register_gauge("mapper_ingest_jobs", "Mapping jobs accepted and rejected since startup",
+    lambda: {("result", "accepted"): ingest.accepted, ("result", "rejected"): ingest.rejected})
+  # aiohttp is only needed for the asyncio front-end, serving the queue_* functions of this module
+  if SERVER == "asyncio":
+    import async_server
+    async_server.serve(mapper_address, mapper_port, sys.modules[__name__])
+  else:
+    waitress.serve(app, host=mapper_address, port=mapper_port, _quiet=True, threads=8, connection_limit=1000, cleanup_interval=10, channel_timeout=10)
+  client.loop_stop()
   client.disconnect()
   
\ No newline at end of file
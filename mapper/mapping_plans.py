@@ -0,0 +1,121 @@
+# Software Name: mapping_plans.py
+# SPDX-FileCopyrightText: Copyright (c) 2023 Universidad de Cantabria
+# SPDX-License-Identifier: LGPL-3.0
+#
+# This software is distributed under the LGPL-3.0 license;
+# see the LICENSE file for more details.
+#
+# Author: Victor GONZALEZ (Universidad de Cantabria) <vgonzalez@tlmat.unican.es> et al.
+
+import json, threading, atexit, fcntl, time, os, inspect, configparser, logging
+from collections import OrderedDict
+
+PROGRAM_NAME = inspect.stack()[0][1].split('.py', 1)[0].split('\\')[-1].split('/')[-1]
+PROGRAM_PATH = os.path.dirname(os.path.realpath(__file__))
+
+# Get variables from config file
+config = configparser.ConfigParser()
+config.read(PROGRAM_PATH + '/general.conf')
+LOG_LEVEL = config.getint('mapper','LOG_LEVEL')
+
+# Set up logger
+logger = logging.getLogger(PROGRAM_NAME + "_logger")
+formatter = logging.Formatter('{asctime} {levelname:<8s} | {filename}:{lineno:<4} [{funcName:^30s}] | {message}', style='{')
+handler = logging.StreamHandler()
+handler.setFormatter(formatter)
+handler.setLevel(LOG_LEVEL)
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(handler)
+
+# learned mapping plans, (type, flattened keys) -> list of (field, new key) renames,
+# which also rename the unit data of the fields; every plan keeps the fingerprint of
+# the dictionary and template it was inferred with, and is dropped when they change.
+# They are saved to a JSON file in the background and loaded at startup. At most
+# size plans are kept, dropping the least recently used ones, so sources whose
+# shape keeps changing do not grow the store nor the file without bound
+class PlanStore:
+  def __init__(self, path, interval, size):
+    self.path = path
+    self.interval = interval
+    self.size = size
+    self.plans = OrderedDict() # (type, keys) -> (fingerprint, plan), least recently used first
+    self.fingerprints = dict() # type -> fingerprint of its current files
+    self.lock = threading.Lock()
+    self.dirty = False
+    self.saver = None
+
+  def get(self, model, keys):
+    self.fingerprints[model.tipo] = model.fingerprint
+    entry = self.plans.get((model.tipo, keys))
+    if entry is None: return None
+    if entry[0] != model.fingerprint:
+      with self.lock: self.plans.pop((model.tipo, keys), None)
+      return None
+    with self.lock:
+      if (model.tipo, keys) in self.plans: self.plans.move_to_end((model.tipo, keys))
+    return entry[1]
+
+  def put(self, model, keys, plan):
+    self.fingerprints[model.tipo] = model.fingerprint
+    with self.lock:
+      self.plans[(model.tipo, keys)] = (model.fingerprint, plan)
+      self.plans.move_to_end((model.tipo, keys))
+      while len(self.plans) > self.size: self.plans.popitem(last=False)
+      self.dirty = True
+      if (self.saver is None) and (self.path is not None): self.start()
+
+  def start(self):
+    self.saver = threading.Thread(target=self.run, name="plan_saver", daemon=True)
+    self.saver.start()
+    atexit.register(self.save)
+
+  def run(self):
+    while True:
+      time.sleep(self.interval)
+      self.save()
+
+  def read(self, file):
+    file.seek(0)
+    try: data = json.loads(file.read() or "[]")
+    except ValueError:
+      logger.error("Ignoring unreadable plans file "+self.path)
+      return dict()
+    return {(entry["type"], tuple(entry["keys"])): (entry["fingerprint"], [tuple(rename) for rename in entry["plan"]]) for entry in data}
+
+  def load(self):
+    if (self.path is None) or (not os.path.exists(self.path)): return
+    with open(self.path, "r") as file: plans = self.read(file)
+    with self.lock:
+      # the plans already in memory are the most recent ones
+      for key, entry in reversed(list(plans.items())):
+        if key in self.plans: continue
+        self.plans[key] = entry
+        self.plans.move_to_end(key, last=False)
+      while len(self.plans) > self.size: self.plans.popitem(last=False)
+    logger.info("Loaded "+str(len(plans))+" mapping plans")
+
+  # merge with the plans other mapper processes saved and replace the file atomically
+  def save(self):
+    if (self.path is None) or (not self.dirty): return
+    with self.lock:
+      plans = OrderedDict(self.plans)
+      self.dirty = False
+    try:
+      os.makedirs(os.path.dirname(self.path), exist_ok=True)
+      with open(self.path + ".lock", "a+") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(self.path):
+          with open(self.path, "r") as file: saved = self.read(file)
+          for key, entry in reversed(list(saved.items())):
+            if key in plans: continue
+            plans[key] = entry
+            plans.move_to_end(key, last=False)
+        # drop the plans of dictionaries or templates that changed since, and the least recently used
+        plans = [(key, entry) for key, entry in plans.items() if self.fingerprints.get(key[0], entry[0]) == entry[0]]
+        plans = dict(plans[max(0, len(plans) - self.size):])
+        data = [{"type": tipo, "keys": list(keys), "fingerprint": fingerprint, "plan": [list(rename) for rename in plan]}
+          for (tipo, keys), (fingerprint, plan) in plans.items()]
+        with open(self.path + ".tmp", "w") as file: file.write(json.dumps(data, indent=1))
+        os.replace(self.path + ".tmp", self.path)
+    except OSError as error:
+      logger.error("Could not save the mapping plans: "+str(error))
@@ -0,0 +1,48 @@
+# Software Name: mapping_pool.py
+# SPDX-FileCopyrightText: Copyright (c) 2023 Universidad de Cantabria
+# SPDX-License-Identifier: LGPL-3.0
+#
+# This software is distributed under the LGPL-3.0 license;
+# see the LICENSE file for more details.
+#
+# Author: Victor GONZALEZ (Universidad de Cantabria) <vgonzalez@tlmat.unican.es> et al.
+
+import map_fields
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# load every type once in each worker, so their caches are warm from the start
+def init_worker():
+  map_fields.prewarm()
+
+def map_chunk(medidas, tipo, unitDatas):
+  return map_fields.mapper_batch_keyed(medidas, tipo, unitDatas)
+
+# same interface as map_fields, but mapping in a pool of processes so it is
+# not serialized by the GIL; every worker keeps its own per-type caches, but the
+# duplicates are filtered here by the dedup window of the parent, since records
+# are spread among the workers
+class MappingPool:
+  def __init__(self, workers, chunk_size):
+    self.chunk_size = chunk_size
+    # spawn, since the parent already runs the MQTT and publisher threads
+    context = multiprocessing.get_context("spawn")
+    self.executor = ProcessPoolExecutor(workers, mp_context=context, initializer=init_worker)
+
+  def mapper(self, medida, tipo, unitData, mode="stream"):
+    result = self.executor.submit(map_fields.mapper_keyed, medida, tipo, unitData, mode).result()
+    if (result is None) or map_fields.dedup_window.check(result[0]): return None
+    return result[1]
+
+  # split the batch in chunks mapped by different workers, keeping the order
+  def mapper_batch(self, medidas, tipo, unitDatas):
+    futures = list()
+    for it in range(0, len(medidas), self.chunk_size):
+      futures.append(self.executor.submit(map_chunk, medidas[it:it+self.chunk_size], tipo, unitDatas[it:it+self.chunk_size]))
+    medidas_final = list()
+    for future in futures:
+      medidas_final.extend(medida for key, medida in future.result() if not map_fields.dedup_window.check(key))
+    return medidas_final
+
+  def shutdown(self):
+    self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,94 @@
+# Software Name: metrics.py
+# SPDX-FileCopyrightText: Copyright (c) 2023 Universidad de Cantabria
+# SPDX-License-Identifier: LGPL-3.0
+#
+# This software is distributed under the LGPL-3.0 license;
+# see the LICENSE file for more details.
+#
+# Author: Victor GONZALEZ (Universidad de Cantabria) <vgonzalez@tlmat.unican.es> et al.
+
+import threading, time
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+  def __init__(self):
+    self.buckets = [0] * len(BUCKETS)
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value):
+    self.count += 1
+    self.sum += value
+    for it in range(len(BUCKETS)):
+      if value <= BUCKETS[it]:
+        self.buckets[it] += 1
+        break
+
+histograms = dict() # (stage, type, mode) -> Histogram
+gauges = dict() # name -> (help, function returning a value or a dict of labels -> value)
+lock = threading.Lock()
+
+def observe(stage, tipo, mode, seconds):
+  key = (stage, str(tipo), mode)
+  with lock:
+    histogram = histograms.get(key)
+    if histogram is None:
+      histogram = Histogram()
+      histograms[key] = histogram
+    histogram.observe(seconds)
+
+# time a stage of the mapping: with metrics.Timer("flatten", tipo, mode): ...
+class Timer:
+  __slots__ = ("stage", "tipo", "mode", "start")
+
+  def __init__(self, stage, tipo, mode):
+    self.stage = stage
+    self.tipo = tipo
+    self.mode = mode
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *_):
+    observe(self.stage, self.tipo, self.mode, time.perf_counter() - self.start)
+
+# values computed when the metrics are requested, e.g. cache counters
+def register_gauge(name, help, function):
+  gauges[name] = (help, function)
+
+# label values escaped as the exposition format requires
+def escape(value):
+  return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def labels(pairs):
+  return "{" + ",".join(k + '="' + escape(v) + '"' for k,v in pairs) + "}"
+
+# Prometheus text exposition format
+def render():
+  lines = list()
+  lines.append("# HELP mapper_stage_seconds Time spent in every stage of the mapper")
+  lines.append("# TYPE mapper_stage_seconds histogram")
+  with lock:
+    items = [(key, list(h.buckets), h.count, h.sum) for key, h in sorted(histograms.items())]
+  for (stage, tipo, mode), buckets, count, total in items:
+    base = [("stage", stage), ("type", tipo), ("mode", mode)]
+    cumulative = 0
+    for bound, n in zip(BUCKETS, buckets):
+      cumulative += n
+      lines.append("mapper_stage_seconds_bucket" + labels(base + [("le", bound)]) + " " + str(cumulative))
+    lines.append("mapper_stage_seconds_bucket" + labels(base + [("le", "+Inf")]) + " " + str(count))
+    lines.append("mapper_stage_seconds_count" + labels(base) + " " + str(count))
+    lines.append("mapper_stage_seconds_sum" + labels(base) + " " + repr(total))
+
+  for name, (help, function) in sorted(gauges.items()):
+    lines.append("# HELP " + name + " " + help)
+    lines.append("# TYPE " + name + " gauge")
+    value = function()
+    if isinstance(value, dict):
+      for key, v in value.items(): lines.append(name + labels([key]) + " " + str(v))
+    else:
+      lines.append(name + " " + str(value))
+  return "\n".join(lines) + "\n"
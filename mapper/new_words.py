@@ -0,0 +1,99 @@
+# Software Name: new_words.py
+# SPDX-FileCopyrightText: Copyright (c) 2023 Universidad de Cantabria
+# SPDX-License-Identifier: LGPL-3.0
+#
+# This software is distributed under the LGPL-3.0 license;
+# see the LICENSE file for more details.
+#
+# Author: Victor GONZALEZ (Universidad de Cantabria) <vgonzalez@tlmat.unican.es> et al.
+
+import threading, atexit, fcntl, os, inspect, configparser, logging
+
+PROGRAM_NAME = inspect.stack()[0][1].split('.py', 1)[0].split('\\')[-1].split('/')[-1]
+PROGRAM_PATH = os.path.dirname(os.path.realpath(__file__))
+
+# Get variables from config file
+config = configparser.ConfigParser()
+config.read(PROGRAM_PATH + '/general.conf')
+LOG_LEVEL = config.getint('mapper','LOG_LEVEL')
+
+# Set up logger
+logger = logging.getLogger(PROGRAM_NAME + "_logger")
+formatter = logging.Formatter('{asctime} {levelname:<8s} | {filename}:{lineno:<4} [{funcName:^30s}] | {message}', style='{')
+handler = logging.StreamHandler()
+handler.setFormatter(formatter)
+handler.setLevel(LOG_LEVEL)
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(handler)
+
+# words not found in the dictionary of a type, kept in memory and appended to
+# sdm/<type>/words.txt in batches by a background thread
+class NewWords:
+  def __init__(self, path, interval):
+    self.path = path
+    self.interval = interval
+    self.known = dict() # type -> words already in words.txt or pending
+    self.pending = dict() # type -> words not written yet
+    self.lock = threading.Lock()
+    self.flusher = None
+    self.stop_event = threading.Event()
+    self.paused = False # while mapping the examples at startup, which are not real records
+
+  def file(self, tipo):
+    return self.path + "/" + tipo + "/words.txt"
+
+  def read(self, file):
+    file.seek(0)
+    return set(file.read().split())
+
+  def load(self, tipo):
+    try:
+      with open(self.file(tipo), "r") as file: return self.read(file)
+    except OSError:
+      return set()
+
+  def add(self, tipo, words):
+    if self.paused: return
+    known = self.known.get(tipo)
+    if known is not None:
+      words = [word for word in words if word not in known]
+      if len(words) == 0: return
+
+    with self.lock:
+      if tipo not in self.known: self.known[tipo] = self.load(tipo)
+      known = self.known[tipo]
+      for word in words:
+        if word in known: continue
+        known.add(word)
+        self.pending.setdefault(tipo, list()).append(word)
+      if self.flusher is None: self.start()
+
+  def start(self):
+    self.flusher = threading.Thread(target=self.run, name="new_words_flusher", daemon=True)
+    self.flusher.start()
+    atexit.register(self.flush)
+
+  def run(self):
+    while not self.stop_event.wait(self.interval):
+      self.flush()
+
+  # append the pending words under an exclusive lock of the file, skipping
+  # those written meanwhile by other mapper processes
+  def flush(self):
+    with self.lock:
+      pending = self.pending
+      self.pending = dict()
+
+    for tipo, words in pending.items():
+      try:
+        with open(self.file(tipo), "a+") as file:
+          fcntl.flock(file, fcntl.LOCK_EX)
+          try:
+            written = self.read(file)
+            words = [word for word in words if word not in written]
+            if len(words) == 0: continue
+            os.write(file.fileno(), "".join(word+"\n" for word in words).encode())
+          finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+      except OSError as error:
+        logger.error("Could not write new words of "+tipo+": "+str(error))
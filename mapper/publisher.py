@@ -0,0 +1,142 @@
+# Software Name: publisher.py
+# SPDX-FileCopyrightText: Copyright (c) 2023 Universidad de Cantabria
+# SPDX-License-Identifier: LGPL-3.0
+#
+# This software is distributed under the LGPL-3.0 license;
+# see the LICENSE file for more details.
+#
+# Author: Victor GONZALEZ (Universidad de Cantabria) <vgonzalez@tlmat.unican.es> et al.
+
+import metrics
+import json, queue, threading, zlib, time, os, inspect, configparser, logging
+import paho.mqtt.client as mqtt
+
+PROGRAM_NAME = inspect.stack()[0][1].split('.py', 1)[0].split('\\')[-1].split('/')[-1]
+PROGRAM_PATH = os.path.dirname(os.path.realpath(__file__))
+
+# Get variables from config file
+config = configparser.ConfigParser()
+config.read(PROGRAM_PATH + '/general.conf')
+LOG_LEVEL = config.getint('mapper','LOG_LEVEL')
+
+# Set up logger
+logger = logging.getLogger(PROGRAM_NAME + "_logger")
+formatter = logging.Formatter('{asctime} {levelname:<8s} | {filename}:{lineno:<4} [{funcName:^30s}] | {message}', style='{')
+handler = logging.StreamHandler()
+handler.setFormatter(formatter)
+handler.setLevel(LOG_LEVEL)
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(handler)
+
+# publishes mapped entities from a background thread, so HTTP workers only
+# queue them; batches are split in chunks and at most <window> messages are
+# handed to the MQTT client without being confirmed by on_publish. Payloads are
+# compact JSON or, with encoding "msgpack", MessagePack (the curator tells them
+# apart by the first byte, since JSON entities always start with { or [).
+# With shards > 0 the topics are <type>/<mode>/<shard>, the shard being a stable
+# hash of the entity id, so every entity always goes to the same topic. The order
+# of the updates of an entity is kept end to end only because the ingest queue
+# maps them all on the same worker (see ordering_key in mapper.py), and this
+# single thread then publishes them in the order they were mapped
+class Publisher:
+  def __init__(self, client, chunk_size, window, queue_size, encoding="json", shards=0):
+    self.client = client
+    self.shards = shards
+    if encoding == "msgpack":
+      import msgpack
+      self.serialize = lambda data: msgpack.packb(data, use_bin_type=True)
+    else:
+      self.serialize = lambda data: json.dumps(data, separators=(",",":"))
+    self.chunk_size = chunk_size
+    self.window = window
+    self.queue = queue.Queue(queue_size)
+    self.inflight = 0
+    self.condition = threading.Condition()
+    client.on_publish = self.on_publish
+    client.on_disconnect = self.on_disconnect
+    self.thread = threading.Thread(target=self.run, name="publisher", daemon=True)
+    self.thread.start()
+
+  def shard(self, medida):
+    return zlib.crc32(str(medida["id"]).encode()) % self.shards
+
+  # a single entity on <type>/stream, or the changed attributes of one on <type>/delta
+  def publish_stream(self, tipo, medida, mode="stream"):
+    topic = tipo+"/"+mode
+    if self.shards > 0: topic += "/"+str(self.shard(medida))
+    self.queue.put((tipo, mode, topic, medida))
+
+  # a list of entities on <type>/batch (or deltas on <type>/delta), in chunks
+  # of chunk_size entities, grouped by shard keeping their order
+  def publish_batch(self, tipo, medidas, mode="batch"):
+    if self.shards > 0:
+      groups = dict()
+      for medida in medidas: groups.setdefault(self.shard(medida), list()).append(medida)
+      groups = [(tipo+"/"+mode+"/"+str(shard), group) for shard, group in sorted(groups.items())]
+    else:
+      groups = [(tipo+"/"+mode, medidas)]
+    for topic, group in groups:
+      for it in range(0, len(group), self.chunk_size):
+        self.queue.put((tipo, mode, topic, group[it:it+self.chunk_size]))
+
+  def run(self):
+    while True:
+      tipo, mode, topic, data = self.queue.get()
+      try:
+        with metrics.Timer("serialize", tipo, mode):
+          payload = self.serialize(data)
+        with metrics.Timer("publish", tipo, mode):
+          self.acquire()
+          try:
+            msg_info = self.client.publish(topic, payload)
+          except:
+            self.release()
+            raise
+          if msg_info.rc != mqtt.MQTT_ERR_SUCCESS:
+            self.release()
+            logger.error("Publish on "+topic+" failed: RC "+str(msg_info.rc))
+      except Exception as exception_error:
+        logger.error("Publish on "+topic+" failed: "+str(exception_error))
+      finally:
+        self.queue.task_done()
+
+  def acquire(self):
+    with self.condition:
+      while self.inflight >= self.window: self.condition.wait()
+      self.inflight += 1
+
+  def release(self):
+    with self.condition:
+      if self.inflight > 0: self.inflight -= 1
+      self.condition.notify()
+
+  def on_publish(self, client, userdata, mid):
+    self.release()
+
+  # messages not sent before a disconnection will never be confirmed
+  def on_disconnect(self, client, userdata, rc):
+    with self.condition:
+      self.inflight = 0
+      self.condition.notify_all()
+
+  # wait until everything queued has been handed to the MQTT client and sent,
+  # at most timeout seconds; False if some messages are still pending
+  def join(self, timeout=None):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with self.queue.all_tasks_done:
+      while self.queue.unfinished_tasks:
+        if deadline is None:
+          self.queue.all_tasks_done.wait()
+          continue
+        remaining = deadline - time.monotonic()
+        if remaining <= 0: return False
+        self.queue.all_tasks_done.wait(remaining)
+    with self.condition:
+      while self.inflight > 0:
+        if deadline is None:
+          self.condition.wait()
+          continue
+        remaining = deadline - time.monotonic()
+        if remaining <= 0: return False
+        self.condition.wait(remaining)
+    return True
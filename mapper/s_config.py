@@ -1,10 +0,0 @@
-# Software Name: s_config.py
-# SPDX-FileCopyrightText: Copyright (c) 2023 Universidad de Cantabria
-# SPDX-License-Identifier: LGPL-3.0 
-#
-# This software is distributed under the LGPL-3.0 license;
-# see the LICENSE file for more details.
-#
-# Author: Victor GONZALEZ (Universidad de Cantabria) <vgonzalez@tlmat.unican.es> et al.
-
-medida = dict()
\ No newline at end of file
@@ -7,13 +7,18 @@
 #
 # Author: Victor GONZALEZ (Universidad de Cantabria) <vgonzalez@tlmat.unican.es> et al.
 
-import s_config, copy
 from jmespath import functions
+import json, uuid
 
+# custom functions of the templates; every search uses its own instance with
+# the record being mapped, so concurrent requests do not share any state.
+# id_fields are the mapped fields identifying a source whose records have no
+# id, or None to give them random ids
 class SaltedFunctions(functions.Functions):
     
-    def __init__(self):
-        self.medida = copy.deepcopy(s_config.medida)
+    def __init__(self, medida, id_fields=None):
+        self.medida = medida
+        self.id_fields = id_fields
 
     # from a ISO8601 formatted datetime, get its timestamp
     @functions.signature({'types': ['string']})
@@ -30,10 +35,18 @@ class SaltedFunctions(functions.Functions):
         if "id" in self.medida:
             return "urn:ngsi-ld:" +  t + ":" + str(self.medida["id"])
         else:
-            import uuid
-            nueva_id = str(uuid.uuid4())
+            nueva_id = self.stable_id(t) or str(uuid.uuid4())
             return "urn:ngsi-ld:" +  t + ":" + nueva_id
 
+    # the same id for every record of a source, from its type and identifying
+    # fields; None unless all of them are present, since a subset of them
+    # (e.g. only dataProvider) would merge different sources into one entity
+    def stable_id(self, t):
+        if self.id_fields is None: return None
+        if any(self.medida.get(field) is None for field in self.id_fields): return None
+        identity = {field: self.medida[field] for field in self.id_fields}
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, t + ":" + json.dumps(identity, sort_keys=True, separators=(",",":"))))
+
     @functions.signature()
     def _func_get_date(self):
         if "dateObserved" in self.medida:
@@ -0,0 +1,178 @@
+# Software Name: template_compiler.py
+# SPDX-FileCopyrightText: Copyright (c) 2023 Universidad de Cantabria
+# SPDX-License-Identifier: LGPL-3.0
+#
+# This software is distributed under the LGPL-3.0 license;
+# see the LICENSE file for more details.
+#
+# Author: Victor GONZALEZ (Universidad de Cantabria) <vgonzalez@tlmat.unican.es> et al.
+
+import jmespath, os, inspect, configparser, logging
+
+PROGRAM_NAME = inspect.stack()[0][1].split('.py', 1)[0].split('\\')[-1].split('/')[-1]
+PROGRAM_PATH = os.path.dirname(os.path.realpath(__file__))
+
+# Get variables from config file
+config = configparser.ConfigParser()
+config.read(PROGRAM_PATH + '/general.conf')
+LOG_LEVEL = config.getint('mapper','LOG_LEVEL')
+
+# Set up logger
+logger = logging.getLogger(PROGRAM_NAME + "_logger")
+formatter = logging.Formatter('{asctime} {levelname:<8s} | {filename}:{lineno:<4} [{funcName:^30s}] | {message}', style='{')
+handler = logging.StreamHandler()
+handler.setFormatter(formatter)
+handler.setLevel(LOG_LEVEL)
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(handler)
+
+# same as the field lookup of the jmespath interpreter
+def field(value, name):
+  try:
+    return value.get(name)
+  except AttributeError:
+    return None
+
+def no_field(name):
+  return None
+
+# turns the AST of a template into the source of a python function doing the
+# same as the jmespath interpreter, node by node and in the same order; only
+# the nodes used by the templates are supported
+class Generator:
+  def __init__(self):
+    self.lines = list()
+    self.constants = list()
+    self.count = 0
+
+  def emit(self, line, depth):
+    self.lines.append("  " * depth + line)
+
+  def variable(self):
+    self.count += 1
+    return "v" + str(self.count)
+
+  # bind an expression to a variable when it has to be used more than once
+  def bind(self, value, depth):
+    if value.isidentifier(): return value
+    name = self.variable()
+    self.emit(name + " = " + value, depth)
+    return name
+
+  # python expression with the result of node applied to value, emitting
+  # the statements it needs first
+  def expression(self, node, value, depth):
+    kind = node["type"]
+    if kind == "field":
+      if value == "value": return "get(" + repr(node["value"]) + ")"
+      return "field(" + value + ", " + repr(node["value"]) + ")"
+    if kind == "literal":
+      # the interpreter returns the same object on every search
+      self.constants.append(node["value"])
+      return "constants[" + str(len(self.constants) - 1) + "]"
+    if kind == "current":
+      return value
+    if kind == "subexpression":
+      for child in node["children"]: value = self.expression(child, value, depth)
+      return value
+    if kind == "key_val_pair":
+      return self.expression(node["children"][0], value, depth)
+    if kind == "function_expression":
+      value = self.bind(value, depth)
+      args = [self.bind(self.expression(child, value, depth), depth) for child in node["children"]]
+      return "call(" + repr(node["value"]) + ", [" + ", ".join(args) + "])"
+    if kind == "multi_select_dict":
+      value = self.bind(value, depth)
+      name = self.variable()
+      self.emit(name + " = None", depth)
+      self.emit("if " + value + " is not None:", depth)
+      self.emit(name + " = dict()", depth + 1)
+      for child in node["children"]:
+        self.emit(name + "[" + repr(child["value"]) + "] = " + self.expression(child, value, depth + 1), depth + 1)
+      return name
+    raise NotImplementedError("unsupported node " + kind)
+
+  def function(self, parsed):
+    self.emit("def template(value, functions):", 0)
+    self.emit("call = functions.call_function", 1)
+    self.emit("try: get = value.get", 1)
+    self.emit("except AttributeError: get = no_field", 1)
+    result = self.expression(parsed, "value", 1)
+    self.emit("return " + result, 1)
+    return "\n".join(self.lines) + "\n"
+
+# a template with the same search() as the ones of jmespath.compile, running
+# the generated function, or the interpreter if it could not be generated
+class CompiledTemplate:
+  def __init__(self, expression):
+    self.expression = expression
+    self.source = None
+    self.function = None
+    try:
+      generator = Generator()
+      self.source = generator.function(expression.parsed)
+      scope = {"field": field, "no_field": no_field, "constants": generator.constants}
+      exec(compile(self.source, "<template>", "exec"), scope)
+      self.function = scope["template"]
+    except NotImplementedError as error:
+      logger.warning("Template interpreted by jmespath: "+str(error))
+
+  def search(self, value, options=None):
+    if self.function is None: return self.expression.search(value, options=options)
+    return self.function(value, options.custom_functions)
+
+def compile_template(text):
+  return CompiledTemplate(jmespath.compile(text))
+
+# check that the compiled templates give the same entities as the interpreter,
+# for the example records of every type and random variations of them
+if __name__ == '__main__':
+  import map_fields, json, random, uuid, copy, datetime
+  from s_jmespath import SaltedFunctions
+
+  # fixed ids and dates, so both paths can be compared
+  class FixedDatetime(datetime.datetime):
+    @classmethod
+    def now(cls, tz=None): return cls(2023, 1, 1, tzinfo=tz)
+  datetime.datetime = FixedDatetime
+  # keep the words of the examples out of sdm/*/words.txt
+  map_fields.new_words.add = lambda tipo, words: None
+
+  def run(search, medida):
+    ids = iter(range(1 << 30))
+    uuid.uuid4 = lambda: uuid.UUID(int=next(ids))
+    medida = copy.deepcopy(medida)
+    result = search(medida, jmespath.Options(custom_functions=SaltedFunctions(medida)))
+    return json.dumps(result)
+
+  values = [None, 0, 1.5, "text", True, [], [1, 2], {}, {"a": 1}, {"value": None}]
+  random.seed(0)
+  checked = 0
+  for tipo, (template_file, _) in map_fields.SDM_FILES.items():
+    with open(PROGRAM_PATH + "/templates/" + template_file, "r") as file: text = file.read()
+    compiled = compile_template(text)
+    assert compiled.function is not None, tipo
+    interpreted = jmespath.compile(text)
+
+    model = map_fields.get_model(tipo)
+    with open(PROGRAM_PATH + "/sdm/" + tipo + "/ej.txt", "r") as file: medida = json.loads(file.read())
+    medida_flattened, _ = map_fields.flatten_record(medida, tipo)
+    plan = map_fields.infer_plan(model, medida_flattened)
+    base = map_fields.apply_plan(plan, medida_flattened, {key: "UNIT" for key in medida_flattened})
+    keys = list(base.keys()) + ["id", "dateObserved", "dateModified", "unitDataSalted", "missing"]
+
+    medidas = [base, {}, None, [], "text"]
+    for it in range(300):
+      medida = copy.deepcopy(base)
+      for key in random.sample(keys, random.randint(1, 5)):
+        if random.random() < 0.3: medida.pop(key, None)
+        else: medida[key] = random.choice(values)
+      medidas.append(medida)
+    for medida in medidas:
+      try: expected = run(interpreted.search, medida)
+      except Exception as error: expected = type(error)
+      try: result = run(compiled.search, medida)
+      except Exception as error: result = type(error)
+      assert expected == result, (tipo, medida, expected, result)
+      checked += 1
+  print("Compiled templates match the interpreter on " + str(checked) + " records")